@@ -0,0 +1,107 @@
+import os
+import json
+import numpy as np
+
+# Projects with fewer vectors than this are searched brute force
+ANN_MIN_NODES = int(os.environ.get("DORA_ANN_MIN_NODES", 20000))
+# Lists scanned per query: higher means better recall and slower retrieval
+ANN_NPROBE = int(os.environ.get("DORA_ANN_NPROBE", 10))
+# Centroids are retrained once the store grows past this multiple of the training size
+RETRAIN_GROWTH = 2.0
+
+CENTROIDS_FILE = "ivf_centroids.npy"
+ASSIGN_FILE = "ivf_assign.npy"
+META_FILE = "ivf_meta.json"
+
+
+def _chunks(n, size=8192):
+    for start in range(0, n, size):
+        yield start, min(start + size, n)
+
+
+def assign_lists(vectors, centroids):
+    """Nearest centroid (by inner product) of every row, computed chunk by chunk"""
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start, end in _chunks(len(vectors)):
+        out[start:end] = np.argmax(np.asarray(vectors[start:end]) @ centroids.T, axis=1)
+    return out
+
+
+def train_centroids(vectors, n_lists, iters=10, max_sample=50000, seed=0):
+    """Spherical k-means over a sample of the (normalized) vectors"""
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    sample_idx = np.sort(rng.choice(n, size=min(n, max_sample), replace=False))
+    sample = np.asarray(vectors[sample_idx], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(iters):
+        labels = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=n_lists)
+        # Reseed empty lists with random sample rows
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def n_lists_for(n):
+    return max(1, int(np.sqrt(n)))
+
+
+class IvfIndex:
+    """Inverted-file index: rows grouped by nearest centroid, only the closest lists are scanned"""
+
+    def __init__(self, centroids, assign, trained_on):
+        self.centroids = centroids
+        self.assign = assign
+        self.trained_on = trained_on
+        self.order = np.argsort(assign, kind="stable")
+        self.offsets = np.searchsorted(assign[self.order], np.arange(len(centroids) + 1))
+
+    @classmethod
+    def build(cls, vectors, previous=None, previous_rows=None):
+        """Index `vectors`, reusing `previous` centroids and its assignments of `previous_rows` while it is fresh enough"""
+        n = len(vectors)
+        if previous is not None and n <= previous.trained_on * RETRAIN_GROWTH:
+            kept = previous.assign[previous_rows] if previous_rows is not None else np.empty(0, dtype=np.int32)
+            new = assign_lists(vectors[len(kept):], previous.centroids)
+            return cls(previous.centroids, np.concatenate([kept, new]).astype(np.int32), previous.trained_on)
+        centroids = train_centroids(vectors, n_lists_for(n))
+        return cls(centroids, assign_lists(vectors, centroids), n)
+
+    def candidates(self, query, nprobe=None):
+        """Row numbers in the `nprobe` lists closest to the (normalized) query"""
+        nprobe = min(nprobe or ANN_NPROBE, len(self.centroids))
+        scores = self.centroids @ query
+        probes = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in probes])
+
+    def save(self, persist_dir):
+        for name, array in ((CENTROIDS_FILE, self.centroids), (ASSIGN_FILE, self.assign)):
+            path = os.path.join(persist_dir, name)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path + ".tmp", path)
+        with open(os.path.join(persist_dir, META_FILE), "w") as f:
+            json.dump({"trained_on": self.trained_on, "n_lists": len(self.centroids)}, f)
+
+    @classmethod
+    def load(cls, persist_dir):
+        if not os.path.exists(os.path.join(persist_dir, META_FILE)):
+            return None
+        with open(os.path.join(persist_dir, META_FILE)) as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(persist_dir, CENTROIDS_FILE)),
+                   np.load(os.path.join(persist_dir, ASSIGN_FILE)),
+                   meta["trained_on"])
+
+    @staticmethod
+    def remove(persist_dir):
+        for name in (CENTROIDS_FILE, ASSIGN_FILE, META_FILE):
+            path = os.path.join(persist_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,107 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Cosine similarity above which a new query is treated as the cached one
+SIMILARITY_THRESHOLD = float(os.environ.get("DORA_ANSWER_CACHE_THRESHOLD", 0.95))
+MAX_ENTRIES = int(os.environ.get("DORA_ANSWER_CACHE_ENTRIES", 5000))
+TTL_SECONDS = int(os.environ.get("DORA_ANSWER_CACHE_TTL", 24 * 3600))
+
+
+def history_key(messages):
+    """Hash of the chat history an answer depended on"""
+    h = hashlib.sha256()
+    for msg in messages:
+        h.update(f"{msg['role']}\0{msg['content']}\0".encode("utf-8"))
+    return h.hexdigest()
+
+
+class AnswerCache:
+    """Answers of past queries, found again by embedding similarity.
+
+    Entries are bucketed by (scope, index version, history hash): the scope
+    names the project and how it was queried, the version comes from the
+    index's version stamp, so re-indexing a project makes its old answers
+    unreachable and they are dropped on the next lookup.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (scope, version, history) -> OrderedDict(entry id -> entry); LRU order kept in self.order
+        self.buckets = {}
+        self.order = OrderedDict()
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _drop_stale_versions(self, scope, version):
+        for bucket in [bucket for bucket in self.buckets if bucket[0] == scope and bucket[1] != version]:
+            for entry_id in self.buckets.pop(bucket):
+                self.order.pop(entry_id, None)
+
+    def lookup(self, scope, version, history, embedding):
+        """Cached answer for a near-duplicate query, or None"""
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        now = time.time()
+        with self.lock:
+            self._drop_stale_versions(scope, version)
+            bucket = self.buckets.get((scope, version, history), {})
+            for entry_id in [entry_id for entry_id, entry in bucket.items() if now - entry["created"] > self.ttl]:
+                del bucket[entry_id]
+                self.order.pop(entry_id, None)
+            if bucket:
+                ids = list(bucket)
+                scores = np.stack([bucket[entry_id]["embedding"] for entry_id in ids]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    self.order.move_to_end(ids[best])
+                    return bucket[ids[best]]["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, scope, version, history, embedding, answer):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        with self.lock:
+            self._drop_stale_versions(scope, version)
+            entry_id = self.next_id
+            self.next_id += 1
+            bucket_key = (scope, version, history)
+            self.buckets.setdefault(bucket_key, {})[entry_id] = {
+                "embedding": vector, "answer": answer, "created": time.time()}
+            self.order[entry_id] = bucket_key
+            while len(self.order) > self.max_entries:
+                old_id, old_bucket = self.order.popitem(last=False)
+                self.buckets.get(old_bucket, {}).pop(old_id, None)
+
+    def invalidate(self, scope_prefix):
+        """Forget every answer whose scope starts with `scope_prefix` (e.g. a project's persist dir)"""
+        with self.lock:
+            for bucket in [bucket for bucket in self.buckets if bucket[0].startswith(scope_prefix)]:
+                for entry_id in self.buckets.pop(bucket):
+                    self.order.pop(entry_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.order),
+        }
+
+
+_cache = AnswerCache()
+
+
+def get_answer_cache():
+    """The process-wide answer cache"""
+    return _cache
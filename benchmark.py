@@ -0,0 +1,410 @@
+"""Offline benchmarks for ingest, index size, index load, retrieval, chat turns and data analysis.
+
+Runs the real indexing and query code on a synthetic corpus in a scratch
+directory, with deterministic local stand-ins for the OpenAI LLM and
+embedding model, and writes the results as JSON so runs can be compared:
+
+    python benchmark.py --docs 50 --pages 10 --mix txt=2,csv=1,pptx=1 --out results.json
+    python benchmark.py --compare old.json new.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import shutil
+import tempfile
+import subprocess
+from typing import Any, List
+import numpy as np
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.llms import CustomLLM, CompletionResponse, CompletionResponseGen, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ROLE = "bench@example.com"
+PROJECT = "bench"
+
+_word_re = re.compile(r"\w+")
+
+# Questions and the pandas code an LLM writes for them, on the corpus CSVs (id, category, value, note)
+ANALYSIS_QUERIES = [
+    ("average value", "df['value'].mean()"),
+    ("total value per category", "df.groupby('category')['value'].sum()"),
+    ("how many rows of each category", "df['category'].value_counts()"),
+    ("the 5 rows with the highest value", "df.sort_values('value', ascending=False).head(5)"),
+    ("how many values are above 500", "df[df['value'] > 500].shape[0]"),
+]
+
+
+class HashEmbedding(BaseEmbedding):
+    """Deterministic bag-of-words embedding: every word is hashed to a signed dimension.
+
+    Texts sharing words get similar vectors, so retrieval results are meaningful.
+    `latency` seconds are slept per call to stand in for the API round-trip.
+    """
+
+    dim: int = 256
+    latency: float = 0.0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _word_re.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+
+class ScriptedLLM(CustomLLM):
+    """Deterministic LLM: answers with words picked from the end of the prompt.
+
+    `first_token_latency` and `token_latency` (seconds) stand in for the API's
+    time to first token and generation speed.
+    """
+
+    answer_tokens: int = 64
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScriptedLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=128000, num_output=self.answer_tokens, model_name="scripted")
+
+    def _tokens(self, prompt):
+        words = _word_re.findall(prompt) or ["ok"]
+        return [words[-(i % len(words)) - 1] + " " for i in range(self.answer_tokens)]
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.first_token_latency + self.token_latency * self.answer_tokens)
+        return CompletionResponse(text="".join(self._tokens(prompt)))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        def gen():
+            text = ""
+            time.sleep(self.first_token_latency)
+            for token in self._tokens(prompt):
+                time.sleep(self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+        return gen()
+
+
+def _vocabulary(rng, size=3000):
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa", "qui", "dor", "an", "el", "os"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def _paragraph(rng, vocab, words=120):
+    sentences, left = [], words
+    while left > 0:
+        n = min(left, rng.randint(8, 20))
+        sentences.append(" ".join(rng.choice(vocab) for _ in range(n)).capitalize() + ".")
+        left -= n
+    return " ".join(sentences)
+
+
+def make_corpus(folder, docs=20, pages=5, mix="txt=2,csv=1,pptx=1", seed=0):
+    """Write `docs` synthetic files of `pages` pages each, file types weighted by `mix`.
+
+    Returns the vocabulary, so queries can be drawn from the same words.
+    """
+    rng = random.Random(seed)
+    vocab = _vocabulary(rng)
+    weights = {kind: int(weight) for kind, weight in (item.split("=") for item in mix.split(","))}
+    kinds = [kind for kind, weight in weights.items() for _ in range(weight)]
+    os.makedirs(folder, exist_ok=True)
+    for i in range(docs):
+        kind = kinds[i % len(kinds)]
+        path = os.path.join(folder, f"doc_{i:05d}.{kind}")
+        if kind == "txt":
+            with open(path, "w") as f:
+                f.write("\n\n".join(_paragraph(rng, vocab, 300) for _ in range(pages)))
+        elif kind == "csv":
+            with open(path, "w") as f:
+                f.write("id,category,value,note\n")
+                for row in range(pages * 50):
+                    f.write(f"{row},{rng.choice(vocab[:20])},{rng.random() * 1000:.2f},{rng.choice(vocab)} {rng.choice(vocab)}\n")
+        elif kind == "pptx":
+            import pptx
+            deck = pptx.Presentation()
+            for _ in range(pages):
+                slide = deck.slides.add_slide(deck.slide_layouts[1])
+                slide.shapes.title.text = " ".join(rng.choice(vocab) for _ in range(4)).title()
+                slide.placeholders[1].text = _paragraph(rng, vocab, 150)
+            deck.save(path)
+        else:
+            raise ValueError(f"Unknown file type in mix: {kind}")
+    return vocab
+
+
+def _dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _latency_stats(seconds):
+    seconds = np.asarray(seconds)
+    return {"n": int(len(seconds)), "mean_ms": float(seconds.mean() * 1000),
+            "p50_ms": float(np.percentile(seconds, 50) * 1000), "p95_ms": float(np.percentile(seconds, 95) * 1000)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    # The app's modules use paths relative to the working directory, and read their settings at import
+    workdir = tempfile.mkdtemp(prefix="dora-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("DORA_TRACE_DIR", os.path.join(workdir, "traces"))
+    # Caches filled by earlier runs (or by the app) would make ingest look faster than it is
+    os.environ["DORA_CACHE_DIR"] = os.path.join(workdir, ".cache")
+
+    from llama_index.core import Settings
+    from embed_cache import install_embedding_cache
+    Settings.embed_model = HashEmbedding(dim=args.embed_dim, latency=args.embed_latency)
+    Settings.llm = ScriptedLLM(first_token_latency=args.llm_first_token, token_latency=args.llm_token_latency)
+    install_embedding_cache()
+    from tracing import install_tracing
+    install_tracing()
+
+    from indexer import create_index, index_dir, summary_dir, load_manifest
+    from index_cache import LOADERS, get_index, get_bm25
+    from bm25 import HybridRetriever
+    from engine_pool import ChatSession
+    from tracing import get_tracer
+
+    results = {}
+    folder = os.path.join(ROLE, PROJECT)
+    vocab = make_corpus(folder, args.docs, args.pages, args.mix, args.seed)
+    corpus_bytes = _dir_bytes(folder)
+
+    pool = None
+    if args.parse_workers:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(args.parse_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    start = time.perf_counter()
+    create_index(ROLE, PROJECT, parse_pool=pool)
+    elapsed = time.perf_counter() - start
+    nodes = sum(len(entry["node_ids"]) for entry in load_manifest(ROLE, PROJECT)["files"].values())
+    results["ingest"] = {"seconds": elapsed, "files": args.docs, "nodes": nodes, "corpus_bytes": corpus_bytes,
+                         "files_per_s": args.docs / elapsed, "nodes_per_s": nodes / elapsed,
+                         "mb_per_s": corpus_bytes / elapsed / 1e6}
+
+    # One changed file: the incremental path
+    text_files = sorted(name for name in os.listdir(folder) if not name.endswith(".pptx"))
+    if text_files:
+        with open(os.path.join(folder, text_files[0]), "a") as f:
+            f.write("\n")
+        start = time.perf_counter()
+        create_index(ROLE, PROJECT, parse_pool=pool)
+        results["ingest_incremental"] = {"seconds": time.perf_counter() - start}
+    if pool is not None:
+        pool.shutdown()
+
+    results["size"] = {"index_bytes": _dir_bytes(index_dir(ROLE, PROJECT)),
+                       "summary_bytes": _dir_bytes(summary_dir(ROLE, PROJECT))}
+    results["size"]["bytes_per_node"] = (results["size"]["index_bytes"] + results["size"]["summary_bytes"]) / max(nodes, 1)
+
+    results["load"] = {}
+    for kind in ("index", "bm25"):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            LOADERS[kind](index_dir(ROLE, PROJECT))
+            times.append(time.perf_counter() - start)
+        results["load"][kind] = _latency_stats(times)
+
+    rng = random.Random(args.seed + 1)
+    queries = [" ".join(rng.choice(vocab) for _ in range(rng.randint(3, 8))) + "?" for _ in range(args.queries)]
+    index = get_index(index_dir(ROLE, PROJECT))
+    bm25 = get_bm25(index_dir(ROLE, PROJECT))
+    retrievers = {
+        "vector": index.as_retriever(similarity_top_k=3),
+        "hybrid": HybridRetriever(index, bm25, similarity_top_k=3, alpha=0.5),
+    }
+    results["retrieval"] = {}
+    for name, retriever in retrievers.items():
+        times = []
+        for query in queries:
+            start = time.perf_counter()
+            retriever.retrieve(query)
+            times.append(time.perf_counter() - start)
+        results["retrieval"][name] = _latency_stats(times)
+
+    # Whole chat turns as the Query page runs them: pooled engine, memory, compression, streaming
+    session = ChatSession(Settings.llm)
+    engine = session.engine(("bench", "hybrid"), lambda: retrievers["hybrid"], "You are a helpful assistant.")
+    first_tokens, totals = [], []
+    for query in queries[:args.turns]:
+        start = time.perf_counter()
+        response = engine.stream_chat(query)
+        first = None
+        for _ in response.response_gen:
+            if first is None:
+                first = time.perf_counter() - start
+        totals.append(time.perf_counter() - start)
+        first_tokens.append(first if first is not None else totals[-1])
+    results["turn"] = {"first_token": _latency_stats(first_tokens), "total": _latency_stats(totals)}
+
+    csv_files = sorted(name for name in os.listdir(folder) if name.endswith(".csv"))
+    if csv_files:
+        results["analysis"] = time_analysis(folder, args.repeat)
+
+    results["stages"] = get_tracer().stage_stats()
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "workdir": workdir,
+            "params": vars(args),
+        },
+        "results": results,
+    }
+
+
+def time_analysis(folder, repeat):
+    """The Data Analysis page's pandas path, LLM calls aside: catalog, dataset pick, prompt, sandboxed code"""
+    from catalog import update_catalog, select_dataset, profile_text
+    from out_of_core import ChunkedInstructionParser, ERROR_PREFIX
+    from sandbox import get_sandbox
+
+    results = {}
+    # Cold: every CSV is profiled (as at upload), warm: nothing changed since
+    for name in ("catalog_cold", "catalog_warm"):
+        start = time.perf_counter()
+        catalog = update_catalog(ROLE, PROJECT)
+        results[name] = {"seconds": time.perf_counter() - start, "files": len(catalog)}
+
+    times, picks = [], []
+    for query, _ in ANALYSIS_QUERIES:
+        start = time.perf_counter()
+        pick = select_dataset(query, catalog) or sorted(catalog)[0]
+        profile_text(catalog[pick]["profile"])
+        times.append(time.perf_counter() - start)
+        picks.append(os.path.join(folder, pick))
+    results["select"] = _latency_stats(times)
+
+    # Starting the workers and loading the dataset into them, what the page's preload hides
+    pool = get_sandbox()
+    start = time.perf_counter()
+    pool.run(picks[0], "len(df)")
+    results["sandbox_start"] = {"seconds": time.perf_counter() - start}
+
+    first, repeated, in_process, errors = [], [], [], 0
+    for path, (_, expression) in zip(picks, ANALYSIS_QUERIES):
+        for i in range(repeat):
+            start = time.perf_counter()
+            text = pool.run(path, expression)
+            (first if i == 0 else repeated).append(time.perf_counter() - start)
+            errors += text.startswith(ERROR_PREFIX)
+            start = time.perf_counter()
+            ChunkedInstructionParser(path).parse(expression)
+            in_process.append(time.perf_counter() - start)
+    results["sandbox_first"] = _latency_stats(first)
+    if repeated:
+        results["sandbox_repeat"] = _latency_stats(repeated)
+    results["in_process"] = _latency_stats(in_process)
+    results["errors"] = errors
+    return results
+
+
+def _flatten(data, prefix=""):
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old_path, new_path):
+    """Print every metric of two result files side by side with the relative change"""
+    with open(old_path) as f:
+        old = _flatten(json.load(f)["results"])
+    with open(new_path) as f:
+        new = _flatten(json.load(f)["results"])
+    print(f"{'metric':<45} {'old':>12} {'new':>12} {'change':>8}")
+    for key in sorted(set(old) & set(new)):
+        change = f"{(new[key] - old[key]) / old[key]:+.1%}" if old[key] else ""
+        print(f"{key:<45} {old[key]:>12.4g} {new[key]:>12.4g} {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20, help="number of files in the corpus")
+    parser.add_argument("--pages", type=int, default=5, help="pages (paragraphs, slides, 50-row blocks) per file")
+    parser.add_argument("--mix", default="txt=2,csv=1,pptx=1", help="relative weights of the file types")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=50, help="retrieval queries to time")
+    parser.add_argument("--turns", type=int, default=10, help="chat turns to time")
+    parser.add_argument("--repeat", type=int, default=5, help="cold loads to time per store")
+    parser.add_argument("--parse-workers", type=int, default=0, help="parse in a process pool of this size (0: inline)")
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="seconds slept per embedding call")
+    parser.add_argument("--llm-first-token", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="seconds per generated token")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the corpus and indexes")
+    parser.add_argument("--out", help="write the results to this JSON file (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    out = os.path.abspath(args.out) if args.out else None
+    report = run(args)
+    os.chdir(REPO_DIR)
+    if not args.keep:
+        shutil.rmtree(report["meta"]["workdir"], ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w") as f:
+            f.write(text)
+        print(f"Results written to {out}")
+    else:
+        print(text)
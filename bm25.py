@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import math
+from typing import List
+import numpy as np
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+BM25_FILE = "bm25.json"
+CONFIG_FILE = "retrieval.json"
+DEFAULT_CONFIG = {"hybrid": True, "alpha": 0.5}
+
+K1 = 1.2
+B = 0.75
+
+# Keeps identifiers such as part numbers (AB-1234), clause numbers (4.2.1) and emails together
+_token_re = re.compile(r"[a-z0-9]+(?:[._/@-][a-z0-9]+)*")
+
+
+def tokenize(text):
+    return _token_re.findall(text.lower())
+
+
+class BM25Index:
+    """Inverted index (term -> postings of (row, term frequency)) with BM25 scoring.
+
+    Rows removed with delete() are tombstoned and dropped from the postings on persist.
+    """
+
+    def __init__(self, node_ids=None, ref_ids=None, doc_len=None, postings=None):
+        self.node_ids = list(node_ids or [])
+        self.ref_ids = list(ref_ids or [])
+        self.doc_len = list(doc_len or [])
+        # term -> ([rows], [term frequencies])
+        self.postings = postings or {}
+        self.alive = [True] * len(self.node_ids)
+        self._arrays = {}
+
+    def add(self, nodes):
+        for node in nodes:
+            row = len(self.node_ids)
+            tokens = tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, tf in counts.items():
+                rows, tfs = self.postings.setdefault(term, ([], []))
+                rows.append(row)
+                tfs.append(tf)
+            self.node_ids.append(node.node_id)
+            self.ref_ids.append(node.ref_doc_id)
+            self.doc_len.append(len(tokens))
+            self.alive.append(True)
+        self._arrays.clear()
+
+    def delete(self, ref_doc_id):
+        for row, ref_id in enumerate(self.ref_ids):
+            if ref_id == ref_doc_id:
+                self.alive[row] = False
+        self._arrays.clear()
+
+    def _term_arrays(self, term):
+        if term not in self._arrays:
+            rows, tfs = self.postings[term]
+            rows, tfs = np.asarray(rows, dtype=np.int64), np.asarray(tfs, dtype=np.float32)
+            keep = np.asarray(self.alive)[rows]
+            self._arrays[term] = (rows[keep], tfs[keep])
+        return self._arrays[term]
+
+    def search(self, query, top_k):
+        """[(node_id, score), ...] of the best `top_k` rows for the query"""
+        alive = np.asarray(self.alive, dtype=bool)
+        n = int(alive.sum())
+        if n == 0:
+            return []
+        doc_len = np.asarray(self.doc_len, dtype=np.float32)
+        avgdl = float(doc_len[alive].mean()) or 1.0
+        scores = np.zeros(len(self.node_ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            rows, tfs = self._term_arrays(term)
+            if not len(rows):
+                continue
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tfs * (K1 + 1) / (tfs + K1 * (1 - B + B * doc_len[rows] / avgdl))
+        hits = np.flatnonzero(scores > 0)
+        if not len(hits):
+            return []
+        top = hits[np.argsort(-scores[hits])[:top_k]]
+        return [(self.node_ids[row], float(scores[row])) for row in top]
+
+    def persist(self, persist_dir):
+        """Write the live rows, renumbered and without tombstones"""
+        keep = [row for row, alive in enumerate(self.alive) if alive]
+        renumber = {row: new for new, row in enumerate(keep)}
+        postings = {}
+        for term, (rows, tfs) in self.postings.items():
+            pairs = [(renumber[row], tf) for row, tf in zip(rows, tfs) if row in renumber]
+            if pairs:
+                postings[term] = ([row for row, _ in pairs], [tf for _, tf in pairs])
+        data = {
+            "node_ids": [self.node_ids[row] for row in keep],
+            "ref_doc_ids": [self.ref_ids[row] for row in keep],
+            "doc_len": [self.doc_len[row] for row in keep],
+            "postings": postings,
+        }
+        os.makedirs(persist_dir, exist_ok=True)
+        path = os.path.join(persist_dir, BM25_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        self.__init__(data["node_ids"], data["ref_doc_ids"], data["doc_len"], postings)
+
+    @classmethod
+    def load(cls, persist_dir):
+        path = os.path.join(persist_dir, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        postings = {term: (rows, tfs) for term, (rows, tfs) in data["postings"].items()}
+        return cls(data["node_ids"], data["ref_doc_ids"], data["doc_len"], postings)
+
+
+def load_retrieval_config(persist_dir):
+    """Per-project retrieval settings, stored next to the project's vector index"""
+    try:
+        with open(os.path.join(persist_dir, CONFIG_FILE)) as f:
+            return {**DEFAULT_CONFIG, **json.load(f)}
+    except FileNotFoundError:
+        return dict(DEFAULT_CONFIG)
+
+
+def save_retrieval_config(persist_dir, config):
+    with open(os.path.join(persist_dir, CONFIG_FILE), "w") as f:
+        json.dump(config, f)
+
+
+def _min_max(scores):
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {key: 1.0 for key in scores}
+    return {key: (value - low) / (high - low) for key, value in scores.items()}
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuses vector and BM25 results: alpha * vector score + (1 - alpha) * keyword score (both min-max scaled)"""
+
+    def __init__(self, index, bm25, similarity_top_k=3, alpha=0.5, **kwargs):
+        self._index = index
+        self._bm25 = bm25
+        self._top_k = similarity_top_k
+        self._alpha = alpha
+        # Look deeper in each list than we return, so fusion has something to re-rank
+        self._vector_retriever = index.as_retriever(similarity_top_k=similarity_top_k * 2)
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_hits = self._vector_retriever.retrieve(query_bundle)
+        nodes = {hit.node.node_id: hit.node for hit in vector_hits}
+        vector_scores = _min_max({hit.node.node_id: hit.score or 0.0 for hit in vector_hits})
+        keyword_scores = _min_max(dict(self._bm25.search(query_bundle.query_str, self._top_k * 2)))
+
+        missing = [node_id for node_id in keyword_scores if node_id not in nodes]
+        for node_id in missing:
+            # get_nodes raises on ids the docstore no longer has, even with raise_error=False
+            node = self._index.docstore.get_document(node_id, raise_error=False)
+            if node is not None:
+                nodes[node_id] = node
+
+        fused = {
+            node_id: self._alpha * vector_scores.get(node_id, 0.0) + (1 - self._alpha) * keyword_scores.get(node_id, 0.0)
+            for node_id in nodes
+        }
+        best = sorted(fused, key=fused.get, reverse=True)[:self._top_k]
+        return [NodeWithScore(node=nodes[node_id], score=fused[node_id]) for node_id in best]
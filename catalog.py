@@ -0,0 +1,207 @@
+"""Per-project catalog of CSV profiles: columns, types, missing values, ranges and common values.
+
+Profiles are computed once per file version (at upload, or on first use)
+and drive two things on the Visualize page: which CSV a question is about,
+and the compact description of it the LLM writes pandas code from.
+"""
+import os
+import re
+import json
+import threading
+import numpy as np
+from dataset_cache import dataset_hash, load_dataframe
+from out_of_core import CHUNK_ROWS, is_large
+from tracing import span
+from warmup import timed_import
+
+CATALOG_VERSION = 1
+TOP_VALUES = 5
+# Columns with more distinct values than this get no exact cardinality for large files
+MAX_TRACKED_VALUES = 100_000
+# Numeric columns with more distinct values than this are described by their range alone
+CATEGORY_LIMIT = 50
+# Characters of a value shown in a profile
+MAX_VALUE_CHARS = 40
+
+# Other files scoring at least this fraction of the best match are used too, up to MAX_MATCHES in all
+MATCH_RATIO = 0.5
+MAX_MATCHES = 3
+
+_word_re = re.compile(r"[a-z0-9]+")
+_name_re = re.compile(r"\W+")
+_lock = threading.Lock()
+
+
+def catalog_path(role, project_name):
+    return f"{role}/catalog/{project_name}.json"
+
+
+def _plain(value):
+    """A JSON-safe version of a numpy / pandas scalar"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _profile(nulls, distinct, minimum, maximum, counts, rows, dtypes):
+    columns = []
+    for name, dtype in dtypes.items():
+        top = counts[name].head(TOP_VALUES) if counts.get(name) is not None else None
+        columns.append({
+            "name": name,
+            "dtype": str(dtype),
+            "nulls": int(nulls[name]),
+            "distinct": None if distinct.get(name) is None else int(distinct[name]),
+            "min": _plain(minimum.get(name)),
+            "max": _plain(maximum.get(name)),
+            "top": [] if top is None else [[_plain(value), int(count)] for value, count in top.items()],
+        })
+    return {"rows": int(rows), "columns": columns}
+
+
+def profile_dataframe(df):
+    """Profile of every column of a DataFrame; the counts and ranges are computed column-wide at once"""
+    nulls = df.isna().sum()
+    distinct = df.nunique().to_dict()
+    ranged = df.select_dtypes(include=["number", "datetime", "bool"])
+    # Per column: a frame-wide min() would turn int columns into floats next to float ones
+    minimum = {name: ranged[name].min() for name in ranged.columns}
+    maximum = {name: ranged[name].max() for name in ranged.columns}
+    counts = {name: df[name].value_counts() for name in df.columns}
+    return _profile(nulls, distinct, minimum, maximum, counts, len(df), df.dtypes)
+
+
+def profile_csv_chunked(path):
+    """The same profile for a CSV too big to load, merged from chunks of rows"""
+    pd = timed_import("pandas")
+    rows, nulls, minimum, maximum, counts, dtypes = 0, None, {}, {}, {}, None
+    with pd.read_csv(path, chunksize=CHUNK_ROWS) as reader:
+        for chunk in reader:
+            rows += len(chunk)
+            nulls = chunk.isna().sum() if nulls is None else nulls + chunk.isna().sum()
+            dtypes = chunk.dtypes if dtypes is None else dtypes
+            ranged = chunk.select_dtypes(include=["number", "datetime", "bool"])
+            for name in ranged.columns:
+                low, high = ranged[name].min(), ranged[name].max()
+                minimum[name] = low if pd.isna(minimum.get(name, np.nan)) else min(minimum[name], low)
+                maximum[name] = high if pd.isna(maximum.get(name, np.nan)) else max(maximum[name], high)
+            for name in chunk.columns:
+                if name in counts and counts[name] is None:
+                    continue
+                merged = chunk[name].value_counts()
+                if name in counts:
+                    merged = pd.concat([counts[name], merged]).groupby(level=0).sum()
+                # Too many distinct values to count exactly without holding them all
+                counts[name] = merged if len(merged) <= MAX_TRACKED_VALUES else None
+    distinct = {name: len(values) for name, values in counts.items() if values is not None}
+    counts = {name: values.sort_values(ascending=False) for name, values in counts.items() if values is not None}
+    return _profile(nulls, distinct, minimum, maximum, counts, rows, dtypes)
+
+
+def profile_csv(path):
+    with span("profile_csv", file=os.path.basename(path)):
+        if is_large(path):
+            return profile_csv_chunked(path)
+        return profile_dataframe(load_dataframe(path))
+
+
+def load_catalog(role, project_name):
+    try:
+        with open(catalog_path(role, project_name)) as f:
+            catalog = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return catalog["files"] if catalog.get("version") == CATALOG_VERSION else {}
+
+
+def update_catalog(role, project_name):
+    """Profile the project's new and changed CSVs and drop removed ones; returns {file name: entry}"""
+    folder = f"{role}/{project_name}"
+    with _lock:
+        known = load_catalog(role, project_name)
+        files = {}
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(".csv"):
+                continue
+            file_hash = dataset_hash(os.path.join(folder, name))
+            entry = known.get(name)
+            if entry is None or entry["hash"] != file_hash:
+                entry = {"hash": file_hash, "profile": profile_csv(os.path.join(folder, name))}
+            files[name] = entry
+        if files != known:
+            path = catalog_path(role, project_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump({"version": CATALOG_VERSION, "files": files}, f)
+            os.replace(path + ".tmp", path)
+    return files
+
+
+def _short(value):
+    text = str(value)
+    return text if len(text) <= MAX_VALUE_CHARS else text[:MAX_VALUE_CHARS - 3] + "..."
+
+
+def profile_text(profile):
+    """Compact description of a profile for a prompt, one line per column"""
+    rows = profile["rows"]
+    lines = [f"{rows} rows, {len(profile['columns'])} columns:"]
+    for column in profile["columns"]:
+        parts = [f"{column['name']} ({column['dtype']})"]
+        if column["nulls"]:
+            parts.append(f"{column['nulls']} missing")
+        if column["distinct"] is not None:
+            parts.append(f"{column['distinct']} distinct")
+        if column["min"] is not None:
+            parts.append(f"range {_short(column['min'])} to {_short(column['max'])}")
+        # Common values of a continuous column are noise, its range says it all
+        continuous = column["min"] is not None and (column["distinct"] is None or column["distinct"] > CATEGORY_LIMIT)
+        if column["top"] and not continuous and column["top"][0][1] > 1:
+            parts.append("top: " + ", ".join(f"{_short(value)} ({count})" for value, count in column["top"]))
+        elif column["top"] and not continuous:
+            # Unique per row (ids, names): examples say more than counts of 1
+            parts.append("e.g. " + ", ".join(_short(value) for value, _ in column["top"][:3]))
+        lines.append("- " + "; ".join(parts))
+    return "\n".join(lines)
+
+
+def _words(text):
+    # Plurals match their singular: "sales" finds "sale", "regions" finds "region"
+    return {word[:-1] if len(word) > 3 and word.endswith("s") else word
+            for word in _word_re.findall(str(text).lower().replace("_", " "))}
+
+
+def rank_datasets(query, catalog):
+    """The catalog files a question is about, best match first; empty when nothing in it matches.
+
+    Words of the question are matched against each file's name, column names
+    and most common values, in that order of weight. Files scoring at least
+    MATCH_RATIO of the best one are kept, at most MAX_MATCHES of them.
+    """
+    asked = _words(query)
+    scores = {}
+    for name, entry in catalog.items():
+        columns = entry["profile"]["columns"]
+        score = (3 * len(asked & _words(os.path.splitext(name)[0]))
+                 + 2 * len(asked & set().union(*(_words(column["name"]) for column in columns)))
+                 + len(asked & set().union(*(_words(value) for column in columns
+                                             for value, _ in column["top"] if isinstance(value, str)))))
+        if score > 0:
+            scores[name] = score
+    ranked = sorted(scores, key=lambda name: (-scores[name], name))
+    return [name for name in ranked if scores[name] >= MATCH_RATIO * scores[ranked[0]]][:MAX_MATCHES]
+
+
+def select_dataset(query, catalog):
+    """The catalog file a question is most likely about, or None when nothing in it matches"""
+    matches = rank_datasets(query, catalog)
+    return matches[0] if matches else None
+
+
+def frame_name(filename):
+    """The variable another matching CSV is available as in generated code: df_<file name>"""
+    return "df_" + (_name_re.sub("_", os.path.splitext(filename)[0].lower()).strip("_") or "data")
@@ -0,0 +1,140 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+from tracing import get_tracer
+
+# Retrieved context handed to the LLM is cut down to this many tokens
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("DORA_CONTEXT_TOKENS", 1500))
+
+_sentence_re = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in _sentence_re.split(text) if sentence and sentence.strip()]
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def _tokens(text):
+    return len(get_tokenizer()(text))
+
+
+class ContextCompressor(BaseNodePostprocessor):
+    """Shrinks retrieved context before it reaches the prompt.
+
+    Chunks are first picked by MMR, so near-duplicates of an already picked
+    chunk are dropped. If what is left is over the token budget, the best
+    chunks are kept whole while they fit, and the budget left over goes to the
+    most query-relevant sentences of the others (in their original order).
+    Chunk vectors are the retrieved node's own when it carries one, otherwise
+    the embedding of its ingest-time text through Settings.embed_model, a hit
+    in the embedding cache filled at ingest; only sentences of chunks that
+    don't fit whole are embedded anew.
+    """
+
+    token_budget: int = Field(default=CONTEXT_TOKEN_BUDGET)
+    mmr_lambda: float = Field(default=0.7, description="Relevance vs. diversity trade-off of the MMR pass.")
+    duplicate_threshold: float = Field(default=0.95, description="Chunks this similar to a picked one are dropped.")
+    last_stats: Dict[str, int] = Field(default_factory=dict)
+    _embed_model: Any = PrivateAttr()
+
+    def __init__(self, embed_model=None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._embed_model = embed_model
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextCompressor"
+
+    def _mmr(self, query_vector, vectors):
+        relevance = vectors @ query_vector
+        picked, candidates = [], list(range(len(vectors)))
+        while candidates:
+            if picked:
+                redundancy = (vectors[candidates] @ vectors[picked].T).max(axis=1)
+            else:
+                redundancy = np.zeros(len(candidates), dtype=np.float32)
+            mmr = self.mmr_lambda * relevance[candidates] - (1 - self.mmr_lambda) * redundancy
+            best = int(np.argmax(mmr))
+            if redundancy[best] < self.duplicate_threshold:
+                picked.append(candidates[best])
+            candidates.pop(best)
+        return picked
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        self.last_stats = {}
+        if not nodes or query_bundle is None:
+            return nodes
+        embed_model = self._embed_model or Settings.embed_model
+        query_vector = _normalize(query_bundle.embedding or embed_model.get_query_embedding(query_bundle.query_str))
+        before = sum(_tokens(hit.node.get_content()) for hit in nodes)
+
+        chunk_vectors = _normalize(self._chunk_vectors(nodes, embed_model))
+        kept = [nodes[i] for i in self._mmr(query_vector, chunk_vectors)]
+
+        if sum(_tokens(hit.node.get_content()) for hit in kept) > self.token_budget:
+            whole, rest, used = [], [], 0
+            for hit in kept:
+                cost = _tokens(hit.node.get_content())
+                if used + cost <= self.token_budget:
+                    whole.append(hit)
+                    used += cost
+                else:
+                    rest.append(hit)
+            kept = whole + self._prune_sentences(rest, query_vector, embed_model, self.token_budget - used)
+
+        after = sum(_tokens(hit.node.get_content()) for hit in kept)
+        self.last_stats = {"tokens_before": before, "tokens_after": after, "tokens_saved": before - after,
+                           "chunks_before": len(nodes), "chunks_after": len(kept)}
+        get_tracer().count("context_tokens_saved", before - after)
+        return kept
+
+    def _chunk_vectors(self, nodes, embed_model):
+        vectors = [hit.node.embedding for hit in nodes]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Same text (with metadata) as was embedded at ingest, so these are cache hits
+            embedded = embed_model.get_text_embedding_batch(
+                [nodes[i].node.get_content(metadata_mode=MetadataMode.EMBED) for i in missing])
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+        return vectors
+
+    def _prune_sentences(self, hits, query_vector, embed_model, budget):
+        if not hits or budget <= 0:
+            return []
+        sentences, owners = [], []
+        for i, hit in enumerate(hits):
+            for sentence in split_sentences(hit.node.get_content()):
+                sentences.append(sentence)
+                owners.append(i)
+        if not sentences:
+            return []
+        scores = _normalize(embed_model.get_text_embedding_batch(sentences)) @ query_vector
+
+        chosen, used = set(), 0
+        for s in np.argsort(-scores):
+            cost = _tokens(sentences[s])
+            if used + cost > budget:
+                continue
+            chosen.add(int(s))
+            used += cost
+
+        pruned = []
+        for i, hit in enumerate(hits):
+            text = " ".join(sentences[s] for s in range(len(sentences)) if owners[s] == i and s in chosen)
+            if text:
+                # Copy, the original node is shared through the index cache
+                node = hit.node.model_copy()
+                node.set_content(text)
+                pruned.append(NodeWithScore(node=node, score=hit.score))
+        return pruned
@@ -0,0 +1,196 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from tracing import span
+
+CACHE_DIR = os.environ.get("DORA_CACHE_DIR", ".cache")
+# Bump when the column format changes so cached datasets are converted again
+DATASET_FORMAT_VERSION = 1
+# Parsed DataFrames kept in memory, shared by every session (memory-mapped columns count too)
+MAX_CACHE_BYTES = int(os.environ.get("DORA_DATASET_CACHE_MB", 2048)) * 1024 * 1024
+
+META_FILE = "meta.json"
+
+# (path, size, mtime) -> sha256, so a big CSV is only hashed again after it changes
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def dataset_hash(path, block_size=1 << 20):
+    """sha256 of a file's contents (the same hash the index manifest uses)"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    with _hashes_lock:
+        _hashes[key] = h.hexdigest()
+    return _hashes[key]
+
+
+def columns_dir(file_hash):
+    return os.path.join(CACHE_DIR, "datasets", f"{file_hash}-v{DATASET_FORMAT_VERSION}")
+
+
+def _encode_column(directory, number, series):
+    """Write one column, returning its entry for meta.json (None if it can't be stored)"""
+    values = series.to_numpy()
+    if values.dtype.kind in "biufcmM":
+        np.save(os.path.join(directory, f"{number}.npy"), values)
+        return {"kind": "array"}
+    # Text columns are dictionary encoded: codes on disk, the distinct values in JSON
+    codes, uniques = series.factorize(use_na_sentinel=True)
+    uniques = uniques.tolist()
+    if not all(isinstance(value, str) for value in uniques):
+        return None
+    np.save(os.path.join(directory, f"{number}.npy"), codes.astype(np.int32 if len(uniques) < 2 ** 31 else np.int64))
+    with open(os.path.join(directory, f"{number}.json"), "w") as f:
+        json.dump(uniques, f)
+    return {"kind": "dictionary"}
+
+
+def convert_csv(path, file_hash=None):
+    """Parse a CSV once and store its columns as .npy files; returns the directory, or None if it can't be stored"""
+    import pandas as pd
+    file_hash = file_hash or dataset_hash(path)
+    target = columns_dir(file_hash)
+    if os.path.exists(os.path.join(target, META_FILE)):
+        return target
+    with span("dataset_convert", file=os.path.basename(path)):
+        # The same parser the page used to run on every query, so dtypes don't change
+        df = pd.read_csv(path)
+        tmp = f"{target}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            columns = []
+            for number, name in enumerate(df.columns):
+                entry = _encode_column(tmp, number, df[name])
+                if entry is None:
+                    return None
+                columns.append({"name": name, "dtype": str(df[name].dtype), **entry})
+            with open(os.path.join(tmp, META_FILE), "w") as f:
+                json.dump({"rows": len(df), "columns": columns}, f)
+            try:
+                os.replace(tmp, target)
+            except OSError:
+                # Another session converted it first
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return target
+
+
+def load_columns(directory, columns=None):
+    """DataFrame of the stored columns (all, or only `columns`), plus its approximate size in bytes.
+
+    Numeric columns are memory-mapped read-only; the frame is shared between
+    sessions, so in-place writes to it fail instead of leaking into others.
+    """
+    import pandas as pd
+    with open(os.path.join(directory, META_FILE)) as f:
+        meta = json.load(f)
+    wanted = set(columns) if columns is not None else None
+    data, size = {}, 0
+    for number, column in enumerate(meta["columns"]):
+        if wanted is not None and column["name"] not in wanted:
+            continue
+        # A plain ndarray view of the read-only mapping, pandas treats memmap subclasses differently
+        array = np.asarray(np.load(os.path.join(directory, f"{number}.npy"), mmap_mode="r"))
+        if column["kind"] == "dictionary":
+            with open(os.path.join(directory, f"{number}.json")) as f:
+                uniques = np.array(json.load(f) + [np.nan], dtype=object)
+            # Code -1 (missing) picks the trailing NaN
+            array = uniques.take(array)
+            array.flags.writeable = False
+            size += array.size * 8 + sum(len(value) for value in uniques[:-1])
+        else:
+            size += array.nbytes
+        data[column["name"]] = array
+    df = pd.DataFrame(data, copy=False)
+    if columns is not None:
+        df = df[[name for name in columns if name in df.columns]]
+    return df, size
+
+
+class DataFrameCache:
+    """LRU cache of parsed datasets keyed by (file hash, columns), loaded once per key."""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, columns=None):
+        file_hash = dataset_hash(path)
+        key = (file_hash, tuple(columns) if columns is not None else None)
+        with self.lock:
+            for candidate in (key, (file_hash, None)):
+                if candidate in self.entries:
+                    self.entries.move_to_end(candidate)
+                    self.hits += 1
+                    df = self.entries[candidate][0]
+                    return df if candidate == key else df[[name for name in columns if name in df.columns]]
+            load_lock = self.loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    return self.entries[key][0]
+            try:
+                with span("dataset_load", file=os.path.basename(path)):
+                    directory = convert_csv(path, file_hash)
+                    if directory is None:
+                        import pandas as pd
+                        df = pd.read_csv(path, usecols=columns)
+                        size = int(df.memory_usage(deep=False).sum())
+                    else:
+                        df, size = load_columns(directory, columns)
+                with self.lock:
+                    self.misses += 1
+                    self.entries[key] = (df, size)
+                    while sum(size for _, size in self.entries.values()) > self.max_bytes and len(self.entries) > 1:
+                        self.entries.popitem(last=False)
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+        return df
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                    "bytes": sum(size for _, size in self.entries.values())}
+
+
+_cache = DataFrameCache()
+
+
+def load_dataframe(path, columns=None):
+    """A CSV as a DataFrame, from the process-wide cache.
+
+    The frame is shared: it comes back as a shallow copy, so adding or
+    replacing columns is fine, but changing values in place raises.
+    """
+    return _cache.get(path, columns).copy(deep=False)
+
+
+def prepare_datasets(folder):
+    """Convert every CSV in a project folder that isn't converted yet"""
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(".csv"):
+            convert_csv(os.path.join(folder, name))
+
+
+def dataset_cache_stats():
+    return _cache.stats()
@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import zlib
+import numpy as np
+
+DEDUP_FILE = "dedup.json"
+SIGNATURES_FILE = "dedup_signatures.npy"
+# Estimated Jaccard similarity of word shingles above which a chunk is a duplicate (> 1 disables dedup)
+DEDUP_THRESHOLD = float(os.environ.get("DORA_DEDUP_THRESHOLD", 0.95))
+
+SHINGLE_WORDS = 5
+NUM_PERM = 64
+# 16 bands of 4 rows: chunks with Jaccard around 0.5 and up become candidates
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(20240611)
+# a * crc32 + b stays below 2**63, so the uint64 arithmetic never wraps
+_A = _rng.randint(1, 1 << 31, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, NUM_PERM).astype(np.uint64)
+
+_word_re = re.compile(r"\w+")
+
+
+def signature(text):
+    """MinHash signature of the text's word shingles"""
+    words = _word_re.findall(text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0)
+
+
+class DedupIndex:
+    """MinHash LSH over the canonical chunks of a project.
+
+    A chunk found here is not indexed again; the file it came from is
+    recorded as an alias of the canonical chunk instead. This is lossy: the
+    alias's own wording is neither embedded nor searchable, so the indexer only
+    aliases a chunk whose words all appear in the canonical one (see `covers`).
+    """
+
+    def __init__(self, node_ids=None, signatures=None, aliases=None, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.signatures = {}
+        # (band, band hash) -> node ids
+        self.buckets = {}
+        # canonical node id -> names of the other files that contain it
+        self.aliases = aliases or {}
+        for node_id, sig in zip(node_ids or [], signatures if signatures is not None else []):
+            self.add(node_id, sig)
+
+    def _bands(self, sig):
+        return [(band, sig[band * ROWS:(band + 1) * ROWS].tobytes()) for band in range(BANDS)]
+
+    def find(self, sig, exclude=()):
+        """Node id of the canonical chunk `sig` duplicates, or None; chunks in `exclude` are never picked"""
+        candidates = set()
+        for key in self._bands(sig):
+            candidates.update(self.buckets.get(key, ()))
+        candidates.difference_update(exclude)
+        best, best_score = None, self.threshold
+        for node_id in candidates:
+            score = float(np.mean(self.signatures[node_id] == sig))
+            if score >= best_score:
+                best, best_score = node_id, score
+        return best
+
+    def add(self, node_id, sig):
+        self.signatures[node_id] = sig
+        for key in self._bands(sig):
+            self.buckets.setdefault(key, set()).add(node_id)
+
+    def add_alias(self, node_id, file_name):
+        files = self.aliases.setdefault(node_id, [])
+        if file_name not in files:
+            files.append(file_name)
+
+    def remove(self, node_ids):
+        for node_id in node_ids:
+            sig = self.signatures.pop(node_id, None)
+            self.aliases.pop(node_id, None)
+            if sig is None:
+                continue
+            for key in self._bands(sig):
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(node_id)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def remove_file(self, file_name):
+        """Drop a file from the aliases, when it is re-indexed or deleted"""
+        for node_id in list(self.aliases):
+            if file_name in self.aliases[node_id]:
+                self.aliases[node_id].remove(file_name)
+                if not self.aliases[node_id]:
+                    del self.aliases[node_id]
+
+    def persist(self, persist_dir):
+        node_ids = list(self.signatures)
+        signatures = np.stack([self.signatures[n] for n in node_ids]) if node_ids else np.zeros((0, NUM_PERM), np.uint64)
+        path = os.path.join(persist_dir, SIGNATURES_FILE)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, signatures)
+        os.replace(path + ".tmp", path)
+        path = os.path.join(persist_dir, DEDUP_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"node_ids": node_ids, "aliases": self.aliases}, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, persist_dir):
+        try:
+            with open(os.path.join(persist_dir, DEDUP_FILE)) as f:
+                data = json.load(f)
+            signatures = np.load(os.path.join(persist_dir, SIGNATURES_FILE))
+        except FileNotFoundError:
+            return None
+        return cls(data["node_ids"], signatures, data["aliases"])
+
+
+def covers(canonical_text, text):
+    """Whether every word of `text` appears in `canonical_text`, so aliasing it loses no searchable word"""
+    return set(_word_re.findall(text.lower())) <= set(_word_re.findall(canonical_text.lower()))
+
+
+def dedup_stats(manifest):
+    """Chunk counts of a project from its manifest: all chunks, the indexed ones, and the duplicate ratio"""
+    chunks = unique = 0
+    for entry in manifest["files"].values():
+        unique += len(entry["node_ids"])
+        chunks += len(entry["node_ids"]) + len(entry.get("alias_of", []))
+    return {"chunks": chunks, "unique": unique, "duplicate_ratio": 1 - unique / chunks if chunks else 0.0}
@@ -0,0 +1,197 @@
+import os
+import time
+import sqlite3
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+CACHE_DIR = os.environ.get("DORA_CACHE_DIR", ".cache")
+# Upper bound on the stored vectors, least recently used entries are evicted past it
+MAX_CACHE_BYTES = int(os.environ.get("DORA_EMBED_CACHE_MB", 2048)) * 1024 * 1024
+
+
+def text_key(model_name, text, kind="text"):
+    return hashlib.sha256(f"{model_name}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """SQLite store of embeddings keyed by (model, text hash), shared by every project and user"""
+
+    def __init__(self, path=None, max_bytes=MAX_CACHE_BYTES):
+        path = path or os.path.join(CACHE_DIR, "embeddings.sqlite")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, nbytes INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, keys):
+        """Look up many keys at once, returning {key: vector} for the ones present"""
+        found = {}
+        now = time.time()
+        with self.lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if rows:
+                    self.conn.execute(f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})", [now] + chunk)
+            self.conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Store (key, vector) pairs and evict the least recently used entries if over the cap"""
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Trim down to 90% of the cap so we don't evict on every insert
+        excess = total - int(self.max_bytes * 0.9)
+        freed, victims = 0, []
+        for key, nbytes in self.conn.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used"):
+            victims.append((key,))
+            freed += nbytes
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+        self.conn.commit()
+        self.evictions += len(victims)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper that only sends texts missing from the cache to the real model.
+
+    Misses are sent in batches of `miss_batch_size` texts (the inner model's own
+    batch size by default), at most `max_concurrency` batches at a time.
+    """
+
+    miss_batch_size: Optional[int] = None
+    max_concurrency: int = 4
+    _inner: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingStore = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, store: EmbeddingStore = None, **kwargs: Any) -> None:
+        # Hand whole node batches to _get_text_embeddings, we re-batch the misses ourselves
+        kwargs.setdefault("embed_batch_size", 2048)
+        super().__init__(model_name=inner.model_name, **kwargs)
+        self._inner = inner
+        self._store = store or get_store()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self):
+        return self._inner
+
+    @property
+    def store(self):
+        return self._store
+
+    def _embed(self, texts, kind):
+        keys = [text_key(self.model_name, text, kind) for text in texts]
+        found = self._store.get_many(list(dict.fromkeys(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            miss_keys = list(missing)
+            size = self.miss_batch_size or self._inner.embed_batch_size
+            batches = [miss_keys[i:i + size] for i in range(0, len(miss_keys), size)]
+
+            def embed_batch(batch):
+                if kind == "query":
+                    return [self._inner.get_query_embedding(missing[key]) for key in batch]
+                # The public batch call keeps the inner model's batching and instrumentation
+                return self._inner.get_text_embedding_batch([missing[key] for key in batch])
+
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(batches)))) as pool:
+                for batch, vectors in zip(batches, pool.map(embed_batch, batches)):
+                    self._store.put_many(zip(batch, vectors))
+                    found.update(zip(batch, vectors))
+        return [found[key] for key in keys]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([query], "query")[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([text], "text")[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self._get_text_embedding, text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "text")
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The process-wide embedding store, opened on first use"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EmbeddingStore()
+        return _store
+
+
+def install_embedding_cache(inner=None):
+    """Put the cache in front of Settings.embed_model (once per process) and return it"""
+    if isinstance(Settings.embed_model, CachedEmbedding):
+        return Settings.embed_model
+    Settings.embed_model = CachedEmbedding(inner or Settings.embed_model)
+    return Settings.embed_model
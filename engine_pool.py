@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.memory import ChatMemoryBuffer, ChatSummaryMemoryBuffer
+from llama_index.core.chat_engine.context import ContextChatEngine
+from compress import ContextCompressor
+
+# Chat history kept in the prompt, measured with the model tokenizer
+HISTORY_TOKEN_BUDGET = int(os.environ.get("DORA_HISTORY_TOKENS", 3000))
+# Summarise turns that fall out of the budget instead of dropping them (costs an LLM call when it happens)
+SUMMARIZE_HISTORY = os.environ.get("DORA_SUMMARIZE_HISTORY", "0") == "1"
+MAX_SESSIONS = int(os.environ.get("DORA_MAX_CHAT_SESSIONS", 200))
+IDLE_SECONDS = int(os.environ.get("DORA_CHAT_SESSION_IDLE", 3600))
+
+
+def count_tokens(text):
+    return len(get_tokenizer()(text))
+
+
+class ChatSession:
+    """Memory and chat engines of one chat, kept alive between turns"""
+
+    def __init__(self, llm):
+        self.llm = llm
+        if SUMMARIZE_HISTORY:
+            self.memory = ChatSummaryMemoryBuffer.from_defaults(llm=llm, token_limit=HISTORY_TOKEN_BUDGET)
+        else:
+            self.memory = ChatMemoryBuffer.from_defaults(token_limit=HISTORY_TOKEN_BUDGET)
+        self.engines = {}
+        # route key -> the engine's ContextCompressor, for its per-turn token stats
+        self.compressors = {}
+        # How many of the chat's messages the memory already holds
+        self.synced = 0
+        self.last_used = time.time()
+
+    def sync(self, messages):
+        """Put chat messages the memory hasn't seen (restored chats, cached answers) into it"""
+        if self.synced > len(messages):
+            # The chat was cleared or replaced under us
+            self.memory.reset()
+            self.synced = 0
+        for msg in messages[self.synced:]:
+            if msg["role"] in ("user", "assistant") and not msg.get("is_image", False):
+                self.memory.put(ChatMessage(role=msg["role"], content=msg["content"]))
+        self.synced = len(messages)
+
+    def engine(self, route_key, retriever, system_prompt, compress=True):
+        """The chat engine for a retrieval route, created the first time the route is used"""
+        if route_key not in self.engines:
+            # Engines of older index versions can never be used again
+            self.engines = {key: engine for key, engine in self.engines.items() if key[0] == route_key[0]}
+            self.compressors = {key: c for key, c in self.compressors.items() if key in self.engines}
+            postprocessors = []
+            if compress:
+                self.compressors[route_key] = ContextCompressor()
+                postprocessors.append(self.compressors[route_key])
+            self.engines[route_key] = ContextChatEngine.from_defaults(
+                retriever=retriever(),
+                memory=self.memory,
+                system_prompt=system_prompt,
+                llm=self.llm,
+                node_postprocessors=postprocessors,
+            )
+        return self.engines[route_key]
+
+    def context_stats(self, route_key):
+        """Token counts of the last context compression on a route ({} when it isn't compressed)"""
+        compressor = self.compressors.get(route_key)
+        return dict(compressor.last_stats) if compressor is not None else {}
+
+    def record_turn(self, query, answer):
+        """Put a turn answered without a chat engine into the memory"""
+        self.memory.put(ChatMessage(role="user", content=query))
+        self.memory.put(ChatMessage(role="assistant", content=answer))
+
+    def history(self):
+        """The chat history the engines see, trimmed (or summarized) to HISTORY_TOKEN_BUDGET, as message dicts"""
+        return [{"role": msg.role.value, "content": str(msg.content or "")} for msg in self.memory.get()]
+
+    def history_tokens(self):
+        return sum(count_tokens(msg["content"]) for msg in self.history())
+
+
+class EnginePool:
+    """Process-wide pool of chat sessions keyed by (user, project, chat id), evicted LRU or when idle"""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_seconds=IDLE_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def session(self, key, llm_factory):
+        now = time.time()
+        with self.lock:
+            for old_key in [k for k, s in self.sessions.items() if now - s.last_used > self.idle_seconds]:
+                del self.sessions[old_key]
+            if key not in self.sessions:
+                self.sessions[key] = ChatSession(llm_factory())
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(key)
+            session = self.sessions[key]
+            session.last_used = now
+            return session
+
+
+_pool = EnginePool()
+
+
+def get_engine_pool():
+    return _pool
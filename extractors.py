@@ -0,0 +1,137 @@
+import os
+import csv
+import json
+import time
+from concurrent.futures import as_completed
+from llama_index.core import Document
+from tracing import get_tracer, span
+
+CACHE_DIR = os.environ.get("DORA_CACHE_DIR", ".cache")
+# Bump when an extractor changes its output so cached extractions are redone
+EXTRACTOR_VERSION = 1
+
+EXTRACTORS = {}
+
+
+def register_extractor(*extensions):
+    """Register a function path -> [(text, metadata), ...] for the given file extensions"""
+    def wrap(fn):
+        for ext in extensions:
+            EXTRACTORS[ext.lower()] = fn
+        return fn
+    return wrap
+
+
+@register_extractor(".pptx")
+def extract_pptx(path):
+    import pptx
+    parts = []
+    for number, slide in enumerate(pptx.Presentation(path).slides, start=1):
+        text = [shape.text for shape in slide.shapes if hasattr(shape, "text") and shape.text]
+        if text:
+            parts.append(("\n".join(text), {"page_label": str(number)}))
+    return parts
+
+
+@register_extractor(".txt", ".md")
+def extract_text(path):
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        return [(f.read(), {})]
+
+
+@register_extractor(".csv")
+def extract_csv(path):
+    with open(path, newline="", encoding="utf-8", errors="ignore") as f:
+        rows = [", ".join(row) for row in csv.reader(f)]
+    return [("\n".join(rows), {})]
+
+
+def extract_default(path):
+    """Anything without its own extractor (PDF, DOCX, ...) goes through llama-index's readers"""
+    from llama_index.core import SimpleDirectoryReader
+    docs = SimpleDirectoryReader(input_files=[path]).load_data()
+    keep = ("page_label",)
+    return [(doc.text, {key: doc.metadata[key] for key in keep if key in doc.metadata}) for doc in docs]
+
+
+def extract_parts(path):
+    """Run the extractor for a file (inside the parse worker processes)"""
+    ext = os.path.splitext(path)[1].lower()
+    return EXTRACTORS.get(ext, extract_default)(path)
+
+
+def _timed_extract_parts(path):
+    # Timed in the worker, the parent records the span
+    start = time.perf_counter()
+    parts = extract_parts(path)
+    return parts, time.perf_counter() - start
+
+
+def _cache_path(file_hash):
+    return os.path.join(CACHE_DIR, "extract", f"{file_hash}-v{EXTRACTOR_VERSION}.json")
+
+
+def _read_cache(file_hash):
+    try:
+        with open(_cache_path(file_hash)) as f:
+            return [tuple(part) for part in json.load(f)]
+    except FileNotFoundError:
+        return None
+
+
+def _write_cache(file_hash, parts):
+    path = _cache_path(file_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(parts, f)
+    os.replace(path + ".tmp", path)
+
+
+def to_documents(path, parts):
+    """Turn extracted parts into documents with ids and metadata for this path"""
+    base = {"file_name": os.path.basename(path), "file_path": path}
+    # Where the file lives isn't part of what is embedded: the same file in another project
+    # (or of another user) has the same chunks, and hits the embedding cache
+    excluded = list(base)
+    if len(parts) == 1:
+        return [Document(text=parts[0][0], metadata={**base, **parts[0][1]}, id_=path,
+                         excluded_embed_metadata_keys=excluded)]
+    return [Document(text=text, metadata={**base, **meta}, id_=f"{path}_part_{i}", excluded_embed_metadata_keys=excluded)
+            for i, (text, meta) in enumerate(parts)]
+
+
+def extract_file(path, file_hash):
+    """Documents of a single file, served from the extraction cache when possible"""
+    parts = _read_cache(file_hash)
+    if parts is None:
+        with span("parse", file=os.path.basename(path)):
+            parts = extract_parts(path)
+        _write_cache(file_hash, parts)
+    return to_documents(path, parts)
+
+
+def extract_documents(files, pool=None):
+    """Yield (path, docs) for every (path, file_hash) pair as it becomes available.
+
+    Cached files come out first; the rest are extracted on `pool` (a process
+    pool) when given, and cached as they finish.
+    """
+    misses = []
+    for path, file_hash in files:
+        parts = _read_cache(file_hash)
+        if parts is None:
+            misses.append((path, file_hash))
+        else:
+            yield path, to_documents(path, parts)
+
+    if pool is None:
+        for path, file_hash in misses:
+            yield path, extract_file(path, file_hash)
+        return
+    futures = {pool.submit(_timed_extract_parts, path): (path, file_hash) for path, file_hash in misses}
+    for future in as_completed(futures):
+        path, file_hash = futures[future]
+        parts, seconds = future.result()
+        get_tracer().record("parse", seconds, file=os.path.basename(path))
+        _write_cache(file_hash, parts)
+        yield path, to_documents(path, parts)
@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict
+from llama_index.core import load_index_from_storage
+from mmap_store import VECTORS_FILE, storage_context_for
+from bm25 import BM25_FILE, BM25Index
+from tracing import span
+
+VERSION_FILE = "version"
+# Rough budget for loaded indexes, measured by the size of their persisted files
+MAX_CACHE_BYTES = int(os.environ.get("DORA_INDEX_CACHE_MB", 1024)) * 1024 * 1024
+
+
+def read_version(persist_dir):
+    """The version stamp create_index wrote into a persist dir ("0" if there is none)"""
+    try:
+        with open(os.path.join(persist_dir, VERSION_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return "0"
+
+
+def write_version(persist_dir, version):
+    path = os.path.join(persist_dir, VERSION_FILE)
+    with open(path + ".tmp", "w") as f:
+        f.write(version)
+    os.replace(path + ".tmp", path)
+
+
+def _persisted_size(persist_dir):
+    # Memory-mapped vectors live in the shared page cache, not in our process,
+    # and the BM25 index is cached as its own entry
+    return sum(entry.stat().st_size for entry in os.scandir(persist_dir)
+               if entry.is_file() and entry.name not in (VECTORS_FILE, BM25_FILE))
+
+
+def _load_index(persist_dir):
+    return load_index_from_storage(storage_context_for(persist_dir)), _persisted_size(persist_dir)
+
+
+def _load_bm25(persist_dir):
+    bm25 = BM25Index.load(persist_dir)
+    size = os.path.getsize(os.path.join(persist_dir, BM25_FILE)) if bm25 is not None else 0
+    return bm25, size
+
+
+# What can be cached for a persist dir: kind -> loader returning (object, approximate bytes)
+LOADERS = {"index": _load_index, "bm25": _load_bm25}
+
+
+class IndexCache:
+    """LRU cache of loaded indexes shared by every session in the process.
+
+    Entries are keyed by (persist dir, version, kind), so an index rewritten by
+    create_index is reloaded on the next lookup instead of served stale.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, persist_dir, kind="index"):
+        persist_dir = os.path.normpath(persist_dir)
+        version = read_version(persist_dir)
+        key = (persist_dir, version, kind)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            # Only one session loads a given index, the others wait for it
+            load_lock = self.loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key][0]
+            try:
+                with span(f"load_{kind}", project=os.path.basename(persist_dir)):
+                    index, size = LOADERS[kind](persist_dir)
+                with self.lock:
+                    self.misses += 1
+                    self._drop(persist_dir, keep_version=version)
+                    self.entries[key] = (index, size)
+                    self._evict()
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+        return index
+
+    def _drop(self, persist_dir, keep_version=None):
+        for key in [key for key in self.entries if key[0] == persist_dir and key[1] != keep_version]:
+            del self.entries[key]
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone is over budget
+        while len(self.entries) > 1 and sum(size for _, size in self.entries.values()) > self.max_bytes:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, persist_dir):
+        with self.lock:
+            self._drop(os.path.normpath(persist_dir))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": sum(size for _, size in self.entries.values()),
+            }
+
+
+_cache = IndexCache()
+
+
+def get_index(persist_dir):
+    """Load an index through the process-wide cache"""
+    return _cache.get(persist_dir)
+
+
+def get_bm25(persist_dir):
+    """Load a project's BM25 index (None if it has none) through the process-wide cache"""
+    return _cache.get(persist_dir, kind="bm25")
+
+
+def invalidate(persist_dir):
+    _cache.invalidate(persist_dir)
+
+
+def cache_stats():
+    return _cache.stats()
@@ -0,0 +1,299 @@
+import os
+import json
+import hashlib
+import time
+import uuid
+import threading
+from llama_index.core import VectorStoreIndex, SummaryIndex, load_index_from_storage, Settings
+from llama_index.core.ingestion import run_transformations
+from index_cache import write_version, invalidate
+from tracing import span
+from answer_cache import get_answer_cache
+from bm25 import BM25Index, BM25_FILE
+from dedup import DEDUP_THRESHOLD, DedupIndex, covers, dedup_stats, signature
+from extractors import extract_documents, extract_file
+from summary_tree import load_summary_tree, tree_is_current, update_summary_tree
+from mmap_store import VECTOR_FORMAT, JSON_STORE_FILE, is_mmap_store, convert_json_store, new_storage_context, storage_context_for
+
+MANIFEST_FILE = "manifest.json"
+
+# Caps how many index builds may be calling the embedding API at the same time
+EMBED_SLOTS = threading.BoundedSemaphore(int(os.environ.get("DORA_EMBED_CONCURRENCY", 2)))
+# Parsed nodes are inserted (and embedded) in batches of roughly this size
+EMBED_BATCH_NODES = 100
+
+# Precompute the per-file/section/project summary tree used by summary-style queries
+SUMMARY_TREE = os.environ.get("DORA_SUMMARY_TREE", "1") == "1"
+
+_project_locks = {}
+_project_locks_guard = threading.Lock()
+
+
+def _project_lock(role, project_name):
+    with _project_locks_guard:
+        return _project_locks.setdefault((role, project_name), threading.Lock())
+
+
+def index_dir(role, project_name):
+    return f"{role}/index/{project_name}"
+
+
+def summary_dir(role, project_name):
+    return f"{role}/summary/{project_name}"
+
+
+def file_hash(path, block_size=1 << 20):
+    """Return the sha256 of a file's contents"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_project(role, project_name):
+    """Hash every file in the project folder, keyed by file name"""
+    folder = f"{role}/{project_name}"
+    hashes = {}
+    if not os.path.exists(folder):
+        return hashes
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        hashes[name] = file_hash(path)
+    return hashes
+
+
+def load_manifest(role, project_name):
+    path = os.path.join(index_dir(role, project_name), MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(role, project_name, manifest):
+    os.makedirs(index_dir(role, project_name), exist_ok=True)
+    path = os.path.join(index_dir(role, project_name), MANIFEST_FILE)
+    # Write to a temp file first so a crash never leaves a half-written manifest
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def _stores_exist(role, project_name):
+    return (os.path.exists(os.path.join(index_dir(role, project_name), "docstore.json"))
+            and os.path.exists(os.path.join(summary_dir(role, project_name), "docstore.json")))
+
+
+def _load_or_empty(persist_dir, index_cls, fresh):
+    if fresh:
+        if index_cls is VectorStoreIndex:
+            return index_cls(nodes=[], storage_context=new_storage_context())
+        return index_cls(nodes=[])
+    # Move vector indexes persisted as JSON over to the memory-mapped format
+    if (index_cls is VectorStoreIndex and VECTOR_FORMAT == "mmap" and not is_mmap_store(persist_dir)
+            and os.path.exists(os.path.join(persist_dir, JSON_STORE_FILE))):
+        convert_json_store(persist_dir)
+    return load_index_from_storage(storage_context_for(persist_dir))
+
+
+def create_index(role, project_name, progress=None, parse_pool=None):
+    """Build or incrementally update the vector and summary indexes of a project.
+
+    Files whose hash matches the manifest are skipped, changed and removed files
+    have their nodes deleted, and new or changed files are parsed and inserted.
+    `progress(file_name, state)` is called as each file moves through the build,
+    and `parse_pool` is an optional process pool the extractors run on.
+    Returns counts of added, updated, removed and unchanged files.
+    """
+    # Two builds of the same project would clobber each other's stores
+    with _project_lock(role, project_name), span("ingest", project=project_name) as attrs:
+        stats = _create_index(role, project_name, progress or (lambda name, state: None), parse_pool)
+        attrs.update(stats)
+        return stats
+
+
+def _create_index(role, project_name, progress, parse_pool):
+    folder = f"{role}/{project_name}"
+    current = scan_project(role, project_name)
+    manifest = load_manifest(role, project_name)
+
+    # Without a manifest and both stores on disk (e.g. indexes built before the
+    # manifest existed) we can't tell which nodes belong to which file, start over
+    fresh = manifest is None or not _stores_exist(role, project_name)
+    if fresh:
+        manifest = {"files": {}}
+
+    known = manifest["files"]
+    added = [name for name in current if name not in known]
+    updated = [name for name in current if name in known and known[name]["hash"] != current[name]]
+    removed = [name for name in known if name not in current]
+    # Files whose duplicate chunks were skipped in favour of a chunk about to be
+    # deleted have to be indexed again (their texts and embeddings are cached)
+    dropping = set(updated + removed)
+    while True:
+        dropped_nodes = {node_id for name in dropping for node_id in known[name]["node_ids"]}
+        reindex = [name for name, entry in known.items()
+                   if name not in dropping and dropped_nodes.intersection(entry.get("alias_of", []))]
+        if not reindex:
+            break
+        dropping.update(reindex)
+        updated += reindex
+
+    stats = {
+        "added": len(added),
+        "updated": len(updated),
+        "removed": len(removed),
+        "unchanged": len(current) - len(added) - len(updated),
+    }
+    for name in current:
+        if name not in added and name not in updated:
+            progress(name, "unchanged")
+    tree_current = not SUMMARY_TREE or tree_is_current(load_summary_tree(role, project_name), current)
+    has_bm25 = os.path.exists(os.path.join(index_dir(role, project_name), BM25_FILE))
+    if not (fresh or added or updated or removed or not has_bm25):
+        if not tree_current:
+            _update_tree(role, project_name, current, {})
+        stats["dedup"] = dedup_stats(manifest)
+        return stats
+
+    index = _load_or_empty(index_dir(role, project_name), VectorStoreIndex, fresh)
+    summary = _load_or_empty(summary_dir(role, project_name), SummaryIndex, fresh)
+    bm25 = None if fresh else BM25Index.load(index_dir(role, project_name))
+    if bm25 is None:
+        # Projects indexed before BM25 existed get it built from their docstore
+        bm25 = BM25Index()
+        bm25.add(list(index.docstore.docs.values()))
+    dedup = None if fresh else DedupIndex.load(index_dir(role, project_name))
+    if dedup is None:
+        # Likewise the dedup index: every chunk already indexed is canonical
+        dedup = DedupIndex()
+        for node in index.docstore.docs.values():
+            dedup.add(node.node_id, signature(node.get_content()))
+
+    # Canonical chunks whose alias list changes, their metadata is brought in line before persisting
+    aliased = set()
+    # Drop the nodes of every changed or deleted file from both indexes
+    for name in updated + removed:
+        for doc_id in known[name]["doc_ids"]:
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+            summary.delete_ref_doc(doc_id, delete_from_docstore=True)
+            bm25.delete(doc_id)
+        dedup.remove(known[name]["node_ids"])
+        aliased.update(node_id for node_id, files in dedup.aliases.items() if name in files)
+        dedup.remove_file(name)
+        del known[name]
+        if name in removed:
+            progress(name, "removed")
+
+    to_parse = added + updated
+    pending_nodes, pending_files = [], []
+    texts = {}
+
+    def flush():
+        with span("index_batch", nodes=len(pending_nodes)):
+            with EMBED_SLOTS:
+                index.insert_nodes(pending_nodes)
+            summary.insert_nodes(pending_nodes)
+            bm25.add(pending_nodes)
+        for name in pending_files:
+            progress(name, "indexed")
+        pending_nodes.clear()
+        pending_files.clear()
+
+    # Chunks kept by this build, some not in the docstore until the next flush
+    new_nodes = {}
+    files = [(os.path.join(folder, name), current[name]) for name in to_parse]
+    for path, docs in extract_documents(files, parse_pool):
+        name = os.path.basename(path)
+        progress(name, "parsed")
+        if SUMMARY_TREE:
+            texts[name] = "\n\n".join(doc.text for doc in docs)
+        nodes = run_transformations(docs, Settings.transformations, show_progress=False)
+        # Near-duplicates of another file's chunk aren't embedded again, the file becomes an alias of it
+        kept, alias_of = [], []
+        for node in nodes:
+            text = node.get_content()
+            sig = signature(text)
+            canonical = dedup.find(sig, exclude={n.node_id for n in kept}) if DEDUP_THRESHOLD <= 1 else None
+            if canonical is not None:
+                # An edit that adds words must stay searchable, even when the rest is unchanged
+                canonical_node = new_nodes.get(canonical) or index.docstore.get_document(canonical, raise_error=False)
+                if canonical_node is None or not covers(canonical_node.get_content(), text):
+                    canonical = None
+            if canonical is None:
+                dedup.add(node.node_id, sig)
+                kept.append(node)
+                new_nodes[node.node_id] = node
+            else:
+                dedup.add_alias(canonical, name)
+                aliased.add(canonical)
+                alias_of.append(canonical)
+        nodes = kept
+        known[name] = {
+            "hash": current[name],
+            "doc_ids": list(dict.fromkeys(doc.doc_id for doc in docs)),
+            "node_ids": [node.node_id for node in nodes],
+            "alias_of": alias_of,
+        }
+        pending_nodes.extend(nodes)
+        pending_files.append(name)
+        if len(pending_nodes) >= EMBED_BATCH_NODES:
+            flush()
+    if pending_files:
+        flush()
+    _sync_aliases(dedup, aliased, index, summary)
+
+    with span("persist"):
+        index.storage_context.persist(index_dir(role, project_name))
+        summary.storage_context.persist(summary_dir(role, project_name))
+        bm25.persist(index_dir(role, project_name))
+        dedup.persist(index_dir(role, project_name))
+        save_manifest(role, project_name, manifest)
+
+    # A new version stamp makes every process reload the indexes on next use
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    for persist_dir in (index_dir(role, project_name), summary_dir(role, project_name)):
+        write_version(persist_dir, version)
+        invalidate(persist_dir)
+    get_answer_cache().invalidate(f"{role}/{project_name}|")
+
+    # Last, so a failing LLM call never leaves the indexes unversioned; a
+    # stale tree is picked up again on the next build
+    if SUMMARY_TREE:
+        _update_tree(role, project_name, current, texts)
+    stats["dedup"] = dedup_stats(manifest)
+    return stats
+
+
+def _sync_aliases(dedup, node_ids, *indexes):
+    """Copy the files each canonical chunk stands in for into its `aliases` metadata"""
+    for node_id in node_ids:
+        files = dedup.aliases.get(node_id, [])
+        for index in indexes:
+            node = index.docstore.get_document(node_id, raise_error=False)
+            if node is None:
+                # Deleted with its own file
+                continue
+            if files:
+                node.metadata["aliases"] = list(files)
+            else:
+                node.metadata.pop("aliases", None)
+            # Not part of the embedded text, so the stored vector (and the embedding cache key) still match
+            if "aliases" not in node.excluded_embed_metadata_keys:
+                node.excluded_embed_metadata_keys.append("aliases")
+            index.docstore.add_documents([node], allow_update=True)
+
+
+def _update_tree(role, project_name, hashes, texts):
+    folder = f"{role}/{project_name}"
+
+    def load_text(name):
+        return "\n\n".join(doc.text for doc in extract_file(os.path.join(folder, name), hashes[name]))
+
+    with span("summary_tree", project=project_name):
+        update_summary_tree(role, project_name, hashes, texts, load_text)
+    # Answers given from the old tree while this one was built are dropped with it
+    get_answer_cache().invalidate(f"{role}/{project_name}|")
@@ -0,0 +1,129 @@
+import os
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from indexer import create_index, scan_project
+from dataset_cache import prepare_datasets
+from lida_summaries import prepare_summaries
+from catalog import update_catalog
+
+# How many index builds run at once, and how many processes parse files for them
+MAX_JOBS = int(os.environ.get("DORA_MAX_JOBS", 2))
+PARSE_WORKERS = int(os.environ.get("DORA_PARSE_WORKERS", os.cpu_count() or 2))
+# Finished jobs are kept (for their results on the pages) this many seconds, and at most this many of them
+JOB_TTL = float(os.environ.get("DORA_JOB_TTL", 3600))
+MAX_FINISHED_JOBS = int(os.environ.get("DORA_MAX_FINISHED_JOBS", 100))
+
+
+class JobQueue:
+    """Runs index builds in the background so the page script never blocks on them.
+
+    Jobs live in this process (not in st.session_state), so they keep running
+    and stay visible across reruns and browser refreshes of the page.
+    """
+
+    def __init__(self, max_jobs=MAX_JOBS, parse_workers=PARSE_WORKERS):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.runner = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="dora-index")
+        # spawn rather than fork, forking a process that runs Streamlit threads is unsafe
+        self.parse_pool = ProcessPoolExecutor(max_workers=parse_workers,
+                                              mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, role, project_name):
+        """Queue an index build and return its job id.
+
+        If the project already has a build queued or running, that job's id is returned instead.
+        """
+        with self.lock:
+            self._prune()
+            for job in self.jobs.values():
+                if job["role"] == role and job["project"] == project_name and job["status"] in ("queued", "running"):
+                    return job["id"]
+            job = {
+                "id": uuid.uuid4().hex[:10],
+                "role": role,
+                "project": project_name,
+                "status": "queued",
+                "files": {},
+                "stats": None,
+                "error": None,
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+            }
+            self.jobs[job["id"]] = job
+        self.runner.submit(self._run, job)
+        return job["id"]
+
+    def _run(self, job):
+        job["status"] = "running"
+        job["started"] = time.time()
+        try:
+            job["files"] = {name: "queued" for name in scan_project(job["role"], job["project"])}
+
+            def progress(name, state):
+                job["files"][name] = state
+
+            job["stats"] = create_index(job["role"], job["project"], progress=progress, parse_pool=self.parse_pool)
+            # Parse, profile and summarize the CSVs now so the first question about them doesn't pay for it
+            for prepare in (lambda: prepare_datasets(f"{job['role']}/{job['project']}"),
+                            lambda: update_catalog(job["role"], job["project"]),
+                            lambda: prepare_summaries(job["role"], job["project"])):
+                try:
+                    prepare()
+                except Exception:
+                    # Done on first use instead
+                    pass
+            job["status"] = "done"
+        except Exception as e:
+            job["error"] = str(e)
+            job["status"] = "failed"
+        finally:
+            job["finished"] = time.time()
+
+    def _prune(self):
+        """Forget done and failed jobs past JOB_TTL, and the oldest beyond MAX_FINISHED_JOBS (lock held)"""
+        now = time.time()
+        finished = sorted((job for job in self.jobs.values()
+                           if job["status"] in ("done", "failed") and job["finished"] is not None),
+                          key=lambda job: job["finished"], reverse=True)
+        for i, job in enumerate(finished):
+            if i >= MAX_FINISHED_JOBS or now - job["finished"] > JOB_TTL:
+                del self.jobs[job["id"]]
+
+    def get(self, job_id):
+        """A job by id, or None once it has been pruned"""
+        with self.lock:
+            self._prune()
+            return self.jobs.get(job_id)
+
+    def jobs_for(self, role):
+        """All jobs of a user, newest first"""
+        with self.lock:
+            self._prune()
+            jobs = [job for job in self.jobs.values() if job["role"] == role]
+        return sorted(jobs, key=lambda job: job["submitted"], reverse=True)
+
+
+def progress_of(job):
+    """Fraction of the job's files that have been fully handled"""
+    if not job["files"]:
+        return 1.0 if job["status"] in ("done", "failed") else 0.0
+    finished = sum(1 for state in job["files"].values() if state in ("indexed", "unchanged", "removed"))
+    return finished / len(job["files"])
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """The process-wide job queue, created on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
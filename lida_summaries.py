@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import threading
+from dataset_cache import dataset_hash, load_dataframe
+from tracing import span, get_tracer
+from warmup import timed_import
+
+SUMMARY_METHOD = "default"
+# LIDA plots from a sample of bigger datasets (its own reader uses the same cap)
+LIDA_MAX_ROWS = 4500
+
+_lock = threading.Lock()
+
+
+def summaries_dir(role, project_name):
+    return f"{role}/lida/{project_name}"
+
+
+def _summary_path(role, project_name, file_hash):
+    return os.path.join(summaries_dir(role, project_name), f"{file_hash}-{SUMMARY_METHOD}.json")
+
+
+def lida_frame(path):
+    """The DataFrame LIDA works on: the cached CSV with LIDA's column names, sampled like LIDA's reader"""
+    utils = timed_import("lida.utils")
+    df = utils.clean_column_names(load_dataframe(path))
+    if len(df) > LIDA_MAX_ROWS:
+        df = df.sample(LIDA_MAX_ROWS, random_state=42)
+    return df
+
+
+def compute_summary(path, text_gen=None, textgen_config=None, data=None):
+    """LIDA summary of a CSV and the seconds it took (the default method makes no LLM call)"""
+    summarizer = timed_import("lida.components").Summarizer()
+    data = lida_frame(path) if data is None else data
+    start = time.perf_counter()
+    kwargs = {"textgen_config": textgen_config} if textgen_config is not None else {}
+    summary = summarizer.summarize(data=data, text_gen=text_gen, file_name=os.path.basename(path),
+                                   summary_method=SUMMARY_METHOD, **kwargs)
+    return summary, time.perf_counter() - start
+
+
+def save_summary(role, project_name, file_hash, filename, summary, seconds):
+    path = _summary_path(role, project_name, file_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"file": filename, "seconds": seconds, "summary": summary}, f, default=str)
+    os.replace(path + ".tmp", path)
+
+
+def load_summary(role, project_name, file_hash):
+    try:
+        with open(_summary_path(role, project_name, file_hash)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def get_summary(role, project_name, filename, text_gen=None, textgen_config=None, data=None):
+    """LIDA summary of a project CSV, from disk when the file hasn't changed since it was summarized.
+
+    Returns (summary, saved): the seconds the stored summary took to compute
+    (time this chart didn't spend), or None when it was computed now.
+    """
+    path = f"{role}/{project_name}/{filename}"
+    file_hash = dataset_hash(path)
+    stored = load_summary(role, project_name, file_hash)
+    if stored is not None:
+        get_tracer().count("lida_summary_seconds_saved", stored["seconds"])
+        return stored["summary"], stored["seconds"]
+    with span("lida_summarize", file=filename):
+        summary, seconds = compute_summary(path, text_gen, textgen_config, data)
+    save_summary(role, project_name, file_hash, filename, summary, seconds)
+    return summary, None
+
+
+def prepare_summaries(role, project_name):
+    """Summarize the project's new or changed CSVs and drop summaries of files that changed or were removed"""
+    folder = f"{role}/{project_name}"
+    with _lock:
+        current = set()
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(".csv"):
+                continue
+            file_hash = dataset_hash(os.path.join(folder, name))
+            current.add(f"{file_hash}-{SUMMARY_METHOD}.json")
+            if load_summary(role, project_name, file_hash) is None:
+                with span("lida_summarize", file=name, upload=True):
+                    summary, seconds = compute_summary(os.path.join(folder, name))
+                save_summary(role, project_name, file_hash, name, summary, seconds)
+        directory = summaries_dir(role, project_name)
+        if os.path.exists(directory):
+            for name in os.listdir(directory):
+                if name.endswith(".json") and name not in current:
+                    os.remove(os.path.join(directory, name))
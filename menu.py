@@ -3,6 +3,8 @@ import pyrebase
 import json
 from datetime import datetime
 import uuid
+from tracing import span, is_admin
+from warmup import start_warmup
 
 # Initialize Firebase once at the module level 
 def get_firebase():
@@ -28,6 +30,8 @@ def authmenu():
     st.sidebar.page_link("./pages/project.py",label="Projects")
     st.sidebar.page_link("./pages/query.py",label="Query")
     st.sidebar.page_link("./pages/visualize.py",label="Data Analysis")
+    if is_admin(st.session_state.get("role")):
+        st.sidebar.page_link("./pages/metrics.py",label="Metrics")
     
     # Chat management section in sidebar
     st.sidebar.markdown("---")
@@ -100,10 +104,11 @@ def delete_chat(chat_index):
         db = firebase.database()
         
         # Make sure we have a valid auth token
-        if "user" in st.session_state and "idToken" in st.session_state.user:
-            db.child("users").child(user_id).child("chats").child(chat_id).remove(st.session_state.user["idToken"])
-        else:
-            db.child("users").child(user_id).child("chats").child(chat_id).remove()
+        with span("firebase", op="delete_chat"):
+            if "user" in st.session_state and "idToken" in st.session_state.user:
+                db.child("users").child(user_id).child("chats").child(chat_id).remove(st.session_state.user["idToken"])
+            else:
+                db.child("users").child(user_id).child("chats").child(chat_id).remove()
         
         # Update local chat list
         st.session_state.chat_list.pop(chat_index)
@@ -164,11 +169,12 @@ def save_chat_to_firebase():
         db = firebase.database()
         
         # Use authentication token if available
-        if "user" in st.session_state and "idToken" in st.session_state.user:
-            db.child("users").child(user_id).child("chats").child(st.session_state.current_chat_id).set(chat_data, st.session_state.user["idToken"])
-        else:
-            # Try to use a simpler path approach if no token
-            db.child("users").child(user_id).child("chats").child(st.session_state.current_chat_id).set(chat_data)
+        with span("firebase", op="save_chat"):
+            if "user" in st.session_state and "idToken" in st.session_state.user:
+                db.child("users").child(user_id).child("chats").child(st.session_state.current_chat_id).set(chat_data, st.session_state.user["idToken"])
+            else:
+                # Try to use a simpler path approach if no token
+                db.child("users").child(user_id).child("chats").child(st.session_state.current_chat_id).set(chat_data)
         
         # Check if chat exists in chat_list and update it
         updated = False
@@ -203,10 +209,11 @@ def load_chats_from_firebase():
         db = firebase.database()
         
         # Use authentication token if available
-        if "user" in st.session_state and "idToken" in st.session_state.user:
-            chats = db.child("users").child(user_id).child("chats").get(st.session_state.user["idToken"]).val()
-        else:
-            chats = db.child("users").child(user_id).child("chats").get().val()
+        with span("firebase", op="load_chats"):
+            if "user" in st.session_state and "idToken" in st.session_state.user:
+                chats = db.child("users").child(user_id).child("chats").get(st.session_state.user["idToken"]).val()
+            else:
+                chats = db.child("users").child(user_id).child("chats").get().val()
         
         if chats:
             chat_list = list(chats.values())
@@ -219,6 +226,9 @@ def load_chats_from_firebase():
         return []
 
 def menu():
+    # Heavy libraries start loading in the background on the server's first page view
+    start_warmup()
+
     # Initialize chat ID if not present
     if "current_chat_id" not in st.session_state:
         st.session_state.current_chat_id = generate_chat_id()
@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+from typing import Any, List, Optional, Sequence
+import numpy as np
+from llama_index.core import StorageContext
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores import SimpleVectorStore
+from ann import ANN_MIN_NODES, IvfIndex
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "vector_ids.json"
+JSON_STORE_FILE = "default__vector_store.json"
+# "mmap" persists new vector indexes in this format, "json" keeps llama-index's default store
+VECTOR_FORMAT = os.environ.get("DORA_VECTOR_FORMAT", "mmap")
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """Vector store persisted as a float32 matrix that is memory-mapped on load.
+
+    Rows are L2-normalized at write time, so cosine similarity is a single
+    matrix-vector product over the mapped array. Every process mapping the
+    same file shares it through the OS page cache. Rows added or deleted
+    since the last persist are kept in memory and merged on the next persist.
+
+    Stores with at least ANN_MIN_NODES vectors also persist an IVF index, and
+    queries then only scan the lists nearest to the query (`nprobe` can be
+    passed through the retriever's vector_store_kwargs).
+    """
+
+    stores_text: bool = False
+    _matrix: Any = PrivateAttr()
+    _ids: List[str] = PrivateAttr()
+    _ref_ids: List[str] = PrivateAttr()
+    _alive: Any = PrivateAttr()
+    _new_vectors: List[Any] = PrivateAttr()
+    _new_ids: List[str] = PrivateAttr()
+    _new_ref_ids: List[str] = PrivateAttr()
+    _ivf: Any = PrivateAttr()
+    _id_array: Any = PrivateAttr()
+
+    def __init__(self, matrix=None, ids=None, ref_ids=None, ivf=None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._reset(matrix, ids, ref_ids, ivf)
+
+    def _reset(self, matrix, ids, ref_ids, ivf=None):
+        # An IVF index written for a different set of rows is useless, search brute force instead
+        self._ivf = ivf if ivf is not None and len(ivf.assign) == len(ids or []) else None
+        self._matrix = matrix if matrix is not None else np.zeros((0, 0), dtype=np.float32)
+        self._ids = list(ids or [])
+        self._id_array = np.asarray(self._ids, dtype=object)
+        self._ref_ids = list(ref_ids or [])
+        self._alive = np.ones(len(self._ids), dtype=bool)
+        self._new_vectors = []
+        self._new_ids = []
+        self._new_ref_ids = []
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "MmapVectorStore":
+        matrix = np.load(os.path.join(persist_dir, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(persist_dir, IDS_FILE)) as f:
+            ids = json.load(f)
+        return cls(matrix=matrix, ids=ids["node_ids"], ref_ids=ids["ref_doc_ids"], ivf=IvfIndex.load(persist_dir))
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def matrix(self):
+        """The mapped (persisted) rows, including deleted ones"""
+        return self._matrix
+
+    @property
+    def alive(self):
+        return self._alive
+
+    def count(self):
+        """Number of live vectors"""
+        return int(self._alive.sum()) + len(self._new_ids)
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        for node in nodes:
+            self._new_vectors.append(_normalize(node.get_embedding()))
+            self._new_ids.append(node.node_id)
+            self._new_ref_ids.append(node.ref_doc_id)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        for pos, ref_id in enumerate(self._ref_ids):
+            if ref_id == ref_doc_id:
+                self._alive[pos] = False
+        keep = [i for i, ref_id in enumerate(self._new_ref_ids) if ref_id != ref_doc_id]
+        self._new_vectors = [self._new_vectors[i] for i in keep]
+        self._new_ids = [self._new_ids[i] for i in keep]
+        self._new_ref_ids = [self._new_ref_ids[i] for i in keep]
+
+    def _all_rows(self):
+        """(vectors, ids) of every live row, mapped rows first"""
+        ids = [node_id for node_id, alive in zip(self._ids, self._alive) if alive]
+        parts = []
+        if len(self._ids):
+            parts.append(self._matrix if self._alive.all() else self._matrix[self._alive])
+        if self._new_vectors:
+            parts.append(np.vstack(self._new_vectors))
+        ids += self._new_ids
+        if not parts:
+            return np.zeros((0, 0), dtype=np.float32), ids
+        return (parts[0] if len(parts) == 1 else np.vstack(parts)), ids
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("MmapVectorStore does not support metadata filters.")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+        query_vector = _normalize(query.query_embedding)
+        if self._ivf is not None and query.node_ids is None:
+            scores, ids = self._ivf_scores(query_vector, kwargs.get("nprobe"))
+        else:
+            vectors, ids = self._all_rows()
+            if not ids:
+                return VectorStoreQueryResult(similarities=[], ids=[])
+            scores = vectors @ query_vector
+        if query.node_ids is not None:
+            wanted = set(query.node_ids)
+            scores = np.where([node_id in wanted for node_id in ids], scores, -np.inf)
+        if not len(ids):
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        k = min(query.similarity_top_k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = [i for i in top if np.isfinite(scores[i])]
+        return VectorStoreQueryResult(similarities=[float(scores[i]) for i in top], ids=[ids[i] for i in top])
+
+    def _ivf_scores(self, query_vector, nprobe):
+        """Scores of the mapped rows in the probed lists, plus every row added since the last persist"""
+        rows = np.sort(self._ivf.candidates(query_vector, nprobe))
+        rows = rows[self._alive[rows]]
+        scores = [np.asarray(self._matrix[rows]) @ query_vector]
+        ids = [self._id_array[rows]]
+        if self._new_vectors:
+            scores.append(np.vstack(self._new_vectors) @ query_vector)
+            ids.append(np.asarray(self._new_ids, dtype=object))
+        return np.concatenate(scores), np.concatenate(ids)
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """Write the live rows to the directory of `persist_path` and re-map them"""
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        vectors, ids = self._all_rows()
+        ref_ids = [ref_id for ref_id, alive in zip(self._ref_ids, self._alive) if alive] + self._new_ref_ids
+        if vectors.shape[0] == 0:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+
+        # Write new files and swap them in, processes that still map the old file keep a valid view
+        vectors_path = os.path.join(persist_dir, VECTORS_FILE)
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        ids_path = os.path.join(persist_dir, IDS_FILE)
+        with open(ids_path + ".tmp", "w") as f:
+            json.dump({"node_ids": ids, "ref_doc_ids": ref_ids}, f)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(ids_path + ".tmp", ids_path)
+
+        matrix = np.load(vectors_path, mmap_mode="r")
+        ivf = None
+        if len(ids) >= ANN_MIN_NODES:
+            # Mapped rows keep their list, only the rows added since the last persist are assigned
+            kept = np.flatnonzero(self._alive) if self._ivf is not None else None
+            ivf = IvfIndex.build(matrix, self._ivf, kept)
+            ivf.save(persist_dir)
+        else:
+            IvfIndex.remove(persist_dir)
+        self._reset(matrix, ids, ref_ids, ivf)
+
+
+def is_mmap_store(persist_dir):
+    return os.path.exists(os.path.join(persist_dir, VECTORS_FILE))
+
+
+def convert_json_store(persist_dir):
+    """Rewrite a persisted SimpleVectorStore (JSON) as an MmapVectorStore"""
+    json_path = os.path.join(persist_dir, JSON_STORE_FILE)
+    data = SimpleVectorStore.from_persist_path(json_path).data
+    ids = list(data.embedding_dict)
+    store = MmapVectorStore()
+    store._new_vectors = [_normalize(data.embedding_dict[node_id]) for node_id in ids]
+    store._new_ids = ids
+    store._new_ref_ids = [data.text_id_to_ref_doc_id.get(node_id) for node_id in ids]
+    store.persist(json_path)
+    os.remove(json_path)
+    return store
+
+
+def new_storage_context():
+    """Storage context for a brand new vector index in the configured format"""
+    if VECTOR_FORMAT == "mmap":
+        return StorageContext.from_defaults(vector_store=MmapVectorStore())
+    return StorageContext.from_defaults()
+
+
+def storage_context_for(persist_dir):
+    """Storage context for a persisted index, whichever vector store format it uses"""
+    if is_mmap_store(persist_dir):
+        return StorageContext.from_defaults(persist_dir=persist_dir,
+                                           vector_store=MmapVectorStore.from_persist_dir(persist_dir))
+    return StorageContext.from_defaults(persist_dir=persist_dir)
+
+
+if __name__ == "__main__":
+    # python mmap_store.py <role>/index/<project> [...] converts existing JSON stores in place
+    for persist_dir in sys.argv[1:]:
+        if is_mmap_store(persist_dir):
+            print(f"{persist_dir}: already converted")
+            continue
+        store = convert_json_store(persist_dir)
+        print(f"{persist_dir}: converted {store.count()} vectors")
@@ -0,0 +1,71 @@
+import os
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from llama_index.core import Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from tracing import get_tracer
+
+# Projects retrieved from at once, shared by every session in the process
+RETRIEVAL_WORKERS = int(os.environ.get("DORA_RETRIEVAL_WORKERS", 8))
+
+_pool = ThreadPoolExecutor(RETRIEVAL_WORKERS, thread_name_prefix="retrieve")
+
+
+class MultiProjectRetriever(BaseRetriever):
+    """Retrieves from several projects concurrently and merges the hits into one top-k.
+
+    `sources` maps a project name to a function returning that project's
+    retriever. It is called on the worker, so projects whose index isn't in
+    the index cache yet are loaded in parallel too. The query is embedded
+    once and the embedding shared. Every hit is tagged with its project in
+    the node metadata, so the prompt and the answer's sources carry it.
+    """
+
+    def __init__(self, sources, similarity_top_k=5, **kwargs):
+        self._sources = sources
+        self._top_k = similarity_top_k
+        # project -> seconds spent on it by the last query
+        self.last_timings = {}
+        super().__init__(**kwargs)
+
+    def _retrieve_project(self, project, query_bundle):
+        start = time.perf_counter()
+        hits = self._sources[project]().retrieve(query_bundle)
+        elapsed = time.perf_counter() - start
+        get_tracer().record("retrieve_project", elapsed, project=project, nodes=len(hits))
+        return hits, elapsed
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle = QueryBundle(query_bundle.query_str, custom_embedding_strs=query_bundle.custom_embedding_strs,
+                                       embedding=Settings.embed_model.get_query_embedding(query_bundle.query_str))
+        # Each task runs in a copy of our context, so its spans land in the current trace
+        futures = {project: _pool.submit(contextvars.copy_context().run, self._retrieve_project, project, query_bundle)
+                   for project in self._sources}
+        merged, self.last_timings = [], {}
+        for project, future in futures.items():
+            hits, self.last_timings[project] = future.result()
+            for hit in hits:
+                # Copy, the original node is shared through the index cache
+                node = hit.node.model_copy()
+                node.metadata = {**node.metadata, "project": project}
+                # The tag isn't part of the text embedded at ingest, so the compressor's lookups still hit
+                node.excluded_embed_metadata_keys = [*node.excluded_embed_metadata_keys, "project"]
+                merged.append(NodeWithScore(node=node, score=hit.score))
+        # Vector scores are cosine similarities from one embedding model, comparable across
+        # projects; hybrid scores are scaled per project, so each project's best hit ranks equally
+        merged.sort(key=lambda hit: hit.score or 0.0, reverse=True)
+        return merged[:self._top_k]
+
+
+def sources_of(nodes):
+    """{project: hits} of merged nodes, for showing where an answer came from"""
+    counts = {}
+    for hit in nodes:
+        project = hit.node.metadata.get("project")
+        if project is not None:
+            counts[project] = counts.get(project, 0) + 1
+    return counts
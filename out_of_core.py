@@ -0,0 +1,526 @@
+"""Chunked evaluation of generated pandas expressions, for CSVs too big to load.
+
+The expression is parsed and split into parts that can be computed one chunk
+of rows at a time (filters, column selections, counts, sums, means, min/max,
+value counts, unique values, group-by aggregations and top-n rows) and the
+small results they produce. Only the columns the expression names are read,
+filters run on every chunk as it streams past, and the partial results are
+merged. Expressions of any other shape run as before, on the whole DataFrame.
+"""
+import os
+import ast
+import builtins
+import functools
+import numpy as np
+from llama_index.core.output_parsers import ChainableOutputParser
+from llama_index.core.output_parsers.utils import parse_code_markdown
+from dataset_cache import load_dataframe
+from tracing import span
+from warmup import timed_import
+
+# CSVs bigger than this are never loaded whole when the expression can be streamed
+OUT_OF_CORE_BYTES = int(os.environ.get("DORA_OUT_OF_CORE_MB", 512)) * 1024 * 1024
+CHUNK_ROWS = int(os.environ.get("DORA_CHUNK_ROWS", 200_000))
+PLAN_CACHE_SIZE = 256
+# Rows used to check that reading fewer columns doesn't change a result
+SAMPLE_ROWS = 200
+
+AGGREGATES = {"sum", "mean", "min", "max", "count"}
+GROUP_AGGREGATES = AGGREGATES | {"size"}
+TOP_N = {"nlargest", "nsmallest"}
+# Methods whose result for a row depends only on that row
+ROWWISE_METHODS = {
+    "isin", "isna", "notna", "isnull", "notnull", "between", "dropna", "fillna", "astype", "abs", "round", "clip",
+    "contains", "startswith", "endswith", "lower", "upper", "strip", "len", "replace",
+}
+ACCESSORS = {"str", "dt", "loc"}
+# How PandasInstructionParser reports a failed expression; the response prompt sees the same for every failure
+ERROR_PREFIX = "There was an error running the output as Python code. Error message: "
+POST_BUILTINS = {name: getattr(builtins, name) for name in ("round", "abs", "int", "float", "len", "min", "max", "sum")}
+
+
+class NotStreamable(Exception):
+    """Raised while streaming when an expression turns out to need the whole DataFrame after all"""
+
+
+def is_large(path):
+    return os.path.getsize(path) > OUT_OF_CORE_BYTES
+
+
+def _is_df(node):
+    return isinstance(node, ast.Name) and node.id == "df"
+
+
+def _literal(node):
+    try:
+        ast.literal_eval(node)
+        return True
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return False
+
+
+def _rowwise(node, columns):
+    """Whether `node` computes each row of its result from the same row of df alone"""
+    if _is_df(node):
+        return True
+    if isinstance(node, ast.Constant) or (isinstance(node, (ast.List, ast.Tuple, ast.Set)) and _literal(node)):
+        return True
+    if isinstance(node, ast.Slice):
+        return node.lower is None and node.upper is None and node.step is None
+    if isinstance(node, ast.Tuple):
+        return all(_rowwise(elt, columns) for elt in node.elts)
+    if isinstance(node, ast.Subscript):
+        return _rowwise(node.value, columns) and _rowwise(node.slice, columns)
+    if isinstance(node, ast.Attribute):
+        if node.attr.startswith("_") or not _rowwise(node.value, columns):
+            return False
+        if node.attr in columns or node.attr in ACCESSORS:
+            return True
+        # Datetime fields: df.date.dt.year
+        return isinstance(node.value, ast.Attribute) and node.value.attr == "dt"
+    if isinstance(node, ast.Call):
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and func.attr in ROWWISE_METHODS and _rowwise(func.value, columns)):
+            is_to_datetime = (isinstance(func, ast.Attribute) and func.attr == "to_datetime"
+                              and isinstance(func.value, ast.Name) and func.value.id == "pd")
+            if not is_to_datetime:
+                return False
+        return (all(_rowwise(arg, columns) for arg in node.args)
+                and all(_rowwise(kw.value, columns) for kw in node.keywords))
+    if isinstance(node, ast.Compare):
+        return _rowwise(node.left, columns) and all(_rowwise(c, columns) for c in node.comparators)
+    if isinstance(node, ast.BinOp):
+        return _rowwise(node.left, columns) and _rowwise(node.right, columns)
+    if isinstance(node, ast.UnaryOp):
+        return _rowwise(node.operand, columns)
+    return False
+
+
+def _method(node, names):
+    """(receiver, name) when node is a call of one of `names`"""
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in names:
+        return node.func.value, node.func.attr
+    return None, None
+
+
+def _terminal(node, columns):
+    """The streamable computation `node` is, as (kind, source node, options), or None"""
+    if not any(_is_df(child) for child in ast.walk(node)):
+        return None
+    # Aggregations: df[df.a > 1].b.sum(), (df.a > 5).mean(), df[["a", "b"]].count()
+    receiver, name = _method(node, AGGREGATES)
+    if receiver is not None and not node.args and not node.keywords and _rowwise(receiver, columns):
+        return "aggregate", receiver, {"how": name}
+
+    # Group-by aggregations: df.groupby("a")["b"].mean(), df[df.x > 0].groupby(["a", "b"]).size()
+    receiver, name = _method(node, GROUP_AGGREGATES)
+    if receiver is not None and not node.args and not node.keywords:
+        # The grouped columns can be picked with ["b"], [["b", "c"]] or .b
+        selected = ((isinstance(receiver, ast.Subscript) and _literal(receiver.slice))
+                    or (isinstance(receiver, ast.Attribute) and receiver.attr in columns))
+        grouped = receiver.value if selected else receiver
+        frame, _ = _method(grouped, {"groupby"})
+        if (frame is not None and _rowwise(frame, columns) and len(grouped.args) == 1
+                and all(kw.arg in ("sort", "dropna") and _literal(kw.value) for kw in grouped.keywords)
+                and _rowwise(grouped.args[0], columns)):
+            sort = next((ast.literal_eval(kw.value) for kw in grouped.keywords if kw.arg == "sort"), True)
+            return "groupby", receiver, {"how": name, "sort": sort}
+
+    # Value counts and distinct values
+    receiver, name = _method(node, {"value_counts", "unique", "nunique"})
+    if receiver is not None and not node.args and not node.keywords and _rowwise(receiver, columns):
+        return name, receiver, {}
+
+    # Top-n rows: df.nlargest(5, "b"), df.sort_values("b", ascending=False).head(10)
+    receiver, name = _method(node, TOP_N)
+    if receiver is not None and _literal_call(node) and _rowwise(receiver, columns):
+        return "top", receiver, {"call": node}
+    receiver, name = _method(node, {"head"})
+    if receiver is not None and _literal_call(node):
+        n = ast.literal_eval(node.args[0]) if node.args else ast.literal_eval(node.keywords[0].value) if node.keywords else 5
+        ordered, _ = _method(receiver, {"sort_values"})
+        if ordered is not None and _literal_call(receiver) and _rowwise(ordered, columns):
+            by = ast.literal_eval(receiver.args[0]) if receiver.args else next(
+                (ast.literal_eval(kw.value) for kw in receiver.keywords if kw.arg == "by"), None)
+            return "top", ordered, {"call": node, "sort": receiver, "n": n, "by": by}
+        if _rowwise(receiver, columns):
+            return "head", receiver, {"n": n}
+
+    # Row counts: len(df[df.a > 1]), df[df.a > 1].shape[0]
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "len"
+            and len(node.args) == 1 and _rowwise(node.args[0], columns)):
+        return "len", node.args[0], {}
+    if isinstance(node, ast.Attribute) and node.attr == "shape" and _rowwise(node.value, columns):
+        return "shape", node.value, {}
+
+    # Anything else row-wise is materialised, but only its rows and columns: df[df.a > 1][["a", "b"]]
+    if not _is_df(node) and _rowwise(node, columns):
+        return "rows", node, {}
+    return None
+
+
+def _literal_call(node):
+    return all(_literal(arg) for arg in node.args) and all(_literal(kw.value) for kw in node.keywords)
+
+
+class _Extract(ast.NodeTransformer):
+    """Replaces every streamable part of an expression by a placeholder name"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.terminals = []
+        # Column names the streamable parts mention
+        self.used = set()
+
+    def visit(self, node):
+        if isinstance(node, ast.expr):
+            terminal = _terminal(node, self.columns)
+            if terminal is not None:
+                self.terminals.append(terminal)
+                for child in ast.walk(node):
+                    if isinstance(child, ast.Constant) and isinstance(child.value, str) and child.value in self.columns:
+                        self.used.add(child.value)
+                    elif isinstance(child, ast.Attribute) and child.attr in self.columns:
+                        self.used.add(child.attr)
+                return ast.copy_location(ast.Name(id=f"part{len(self.terminals) - 1}", ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def plan_expression(expression, columns):
+    """The streamable parts of an expression and the expression that combines them, or None.
+
+    `columns` is a tuple of the CSV's column names. Plans hold compiled code
+    and are cached, so a repeated question doesn't parse or compile again.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        return None
+    extract = _Extract(set(columns))
+    post = extract.visit(tree)
+    if not extract.terminals:
+        return None
+    allowed = {f"part{i}" for i in range(len(extract.terminals))} | {"pd", "np"} | set(POST_BUILTINS)
+    for node in ast.walk(post):
+        # What's left runs on the merged results and must not need the whole DataFrame
+        if isinstance(node, ast.Name) and node.id not in allowed:
+            return None
+        if isinstance(node, ast.Attribute) and node.attr.startswith("__"):
+            return None
+        if isinstance(node, (ast.Lambda, ast.NamedExpr)):
+            return None
+    terminals = [(kind, compile(ast.Expression(source), "<expression>", "eval"), options)
+                 for kind, source, options in extract.terminals]
+    return {"terminals": terminals, "post": compile(ast.fix_missing_locations(post), "<expression>", "eval"),
+            "columns": [column for column in columns if column in extract.used] or list(columns)[:1]}
+
+
+def _eval(code, df):
+    pd = timed_import("pandas")
+    return eval(code, {"pd": pd, "np": np}, {"df": df})
+
+
+class _Partial:
+    """Running result of one streamable part, fed one chunk at a time"""
+
+    def __init__(self, kind, code, options):
+        self.kind, self.code, self.options = kind, code, options
+        self.parts = []
+        # Sort keys of every row, for sort_values(...).head(n)
+        self.keys = []
+        self.frame = False
+        self.done = False
+
+    def feed(self, chunk):
+        pd = timed_import("pandas")
+        kind, options = self.kind, self.options
+        if kind == "aggregate":
+            value = _eval(self.code, chunk)
+            if options["how"] == "mean":
+                self.parts.append((value.sum(), value.count()))
+            else:
+                self.parts.append(getattr(value, options["how"])())
+        elif kind == "groupby":
+            grouped = _eval(self.code, chunk)
+            how = options["how"]
+            if how == "mean":
+                part = (grouped.sum(), grouped.count())
+                if self.parts:
+                    part = tuple(self._merge_groups([old, new], "sum") for old, new in zip(self.parts[0], part))
+            else:
+                part = grouped.size() if how == "size" else getattr(grouped, how)()
+                if self.parts:
+                    part = self._merge_groups([self.parts[0], part], "min" if how == "min" else "max" if how == "max" else "sum")
+            self.parts = [part]
+        elif kind == "value_counts":
+            values = _eval(self.code, chunk)
+            # DataFrame.value_counts orders its counts by row before sorting them, Series.value_counts by first occurrence
+            self.frame = isinstance(values, pd.DataFrame)
+            counts = values.value_counts(sort=False)
+            if counts.index.nlevels == 1:
+                # A one-column frame's counts come on a one-level MultiIndex, which merging flattens
+                counts.index = counts.index.get_level_values(0)
+            merged = pd.concat(self.parts + [counts])
+            self.parts = [merged.groupby(level=list(range(merged.index.nlevels)), sort=False).sum()]
+        elif kind in ("unique", "nunique"):
+            values = _eval(self.code, chunk)
+            values = values.dropna().unique() if kind == "nunique" else values.unique()
+            self.parts = [pd.unique(np.concatenate(self.parts + [np.asarray(values)]))]
+        elif kind == "top" and "sort" in options:
+            rows = _eval(self.code, chunk)
+            # sort_values doesn't sort stably by default, so which tied rows make the top n depends on the
+            # whole column: every row's sort keys are kept, and only the rows that could be picked
+            self.keys.append(self._sort_keys(rows))
+            rows = pd.concat(self.parts + [rows])
+            keys = self._sort_keys(rows)
+            best = self._apply(options["sort"], keys).head(options["n"])
+            if isinstance(keys, pd.Series):
+                self.parts = [rows[keys.isin(best)]]
+            else:
+                self.parts = [rows[pd.MultiIndex.from_frame(keys).isin(pd.MultiIndex.from_frame(best))]]
+        elif kind == "top":
+            rows = _eval(self.code, chunk)
+            call = options["call"]
+            self.parts = [self._apply(call, pd.concat(self.parts + [self._apply(call, rows)]))]
+        elif kind == "head":
+            self.parts.append(_eval(self.code, chunk).head(options["n"]))
+            self.done = sum(len(part) for part in self.parts) >= options["n"]
+        elif kind in ("len", "shape"):
+            self.parts.append(_eval(self.code, chunk).shape)
+        else:
+            self.parts.append(_eval(self.code, chunk))
+
+    @staticmethod
+    def _apply(call, value):
+        """Run the literal-argument method call `call` on `value`"""
+        args = [ast.literal_eval(arg) for arg in call.args]
+        kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+        return getattr(value, call.func.attr)(*args, **kwargs)
+
+    def _sort_keys(self, rows):
+        """The columns sort_values orders `rows` by (a Series is its own key)"""
+        by = self.options["by"]
+        if by is None:
+            return rows
+        return rows[[by] if isinstance(by, str) else list(by)]
+
+    def _merge_groups(self, parts, how):
+        pd = timed_import("pandas")
+        merged = pd.concat(parts)
+        levels = list(range(merged.index.nlevels))
+        return getattr(merged.groupby(level=levels, sort=self.options["sort"], dropna=False), how)()
+
+    def result(self):
+        pd = timed_import("pandas")
+        kind, parts = self.kind, self.parts
+        if kind == "aggregate":
+            how = self.options["how"]
+            if how == "mean":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    return _combine([total for total, _ in parts], "sum") / _combine([count for _, count in parts], "sum")
+            return _combine(parts, "sum" if how == "count" else how)
+        if kind == "groupby":
+            if self.options["how"] == "mean":
+                total, count = parts[0]
+                return total / count
+            return parts[0]
+        if kind == "value_counts":
+            # Counts in the order value_counts has them before sorting, so its (unstable) sort orders ties alike
+            if not self.frame:
+                return parts[0].sort_values(ascending=False)
+            counts = parts[0].sort_index().sort_values(ascending=False)
+            if counts.index.nlevels == 1:
+                counts.index = pd.MultiIndex.from_arrays([counts.index], names=[counts.index.name])
+            return counts
+        if kind == "unique":
+            return parts[0]
+        if kind == "nunique":
+            return len(parts[0])
+        if kind == "top" and "sort" in self.options:
+            # Sorting the keys of all rows picks the same rows, in the same order, as sorting the whole frame
+            labels = self._apply(self.options["sort"], pd.concat(self.keys)).head(self.options["n"]).index
+            if not labels.is_unique or not labels.isin(parts[0].index).all():
+                raise NotStreamable("the top rows can't be told apart by their index")
+            return parts[0].loc[labels]
+        if kind == "top":
+            return parts[0]
+        if kind == "head":
+            return pd.concat(parts).head(self.options["n"])
+        if kind == "len":
+            return sum(shape[0] for shape in parts)
+        if kind == "shape":
+            return (sum(shape[0] for shape in parts),) + tuple(parts[0][1:])
+        return pd.concat(parts)
+
+
+def _combine(parts, how):
+    """Merge per-chunk aggregates: scalars, or Series with one value per column"""
+    pd = timed_import("pandas")
+    if isinstance(parts[0], pd.Series):
+        return getattr(pd.concat(parts, axis=1), how)(axis=1)
+    return getattr(pd.Series(parts), how)()
+
+
+def _run(plan, path, columns=None, nrows=None):
+    pd = timed_import("pandas")
+    partials = [_Partial(*terminal) for terminal in plan["terminals"]]
+    reader = pd.read_csv(path, usecols=columns, chunksize=CHUNK_ROWS if nrows is None else nrows, nrows=nrows)
+    with reader:
+        for chunk in reader:
+            for partial in partials:
+                if not partial.done:
+                    partial.feed(chunk)
+            if all(partial.done for partial in partials):
+                break
+    values = {f"part{i}": partial.result() for i, partial in enumerate(partials)}
+    return eval(plan["post"], {"pd": pd, "np": np, "__builtins__": POST_BUILTINS}, values)
+
+
+def run_plan(plan, path):
+    """Evaluate a planned expression over the CSV chunk by chunk"""
+    columns = plan["columns"]
+    # Reading only the named columns must not change what the expression sees
+    try:
+        pruned_matches = str(_run(plan, path, columns, SAMPLE_ROWS)) == str(_run(plan, path, None, SAMPLE_ROWS))
+    except Exception:
+        pruned_matches = False
+    return _run(plan, path, columns if pruned_matches else None)
+
+
+def _df_column(node):
+    """The column name of a `df.name` or `df["name"]` node, or None"""
+    if isinstance(node, ast.Attribute) and _is_df(node.value):
+        return node.attr
+    if (isinstance(node, ast.Subscript) and _is_df(node.value) and isinstance(node.slice, ast.Constant)
+            and isinstance(node.slice.value, str)):
+        return node.slice.value
+    return None
+
+
+def missing_column(code, columns):
+    """The error pandas would raise for a `df.name` or `df["name"]` the CSV has no column for, or None"""
+    pd = timed_import("pandas")
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    columns = set(columns)
+    # Columns the code adds to df itself
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Attribute, ast.Subscript)) and isinstance(node.ctx, ast.Store) and _df_column(node):
+            columns.add(_df_column(node))
+    for node in ast.walk(tree):
+        name = _df_column(node)
+        if name is None or name in columns:
+            continue
+        if isinstance(node, ast.Subscript):
+            return repr(name)
+        if not hasattr(pd.DataFrame, name):
+            return f"'DataFrame' object has no attribute '{name}'"
+    return None
+
+
+def header(path):
+    return list(timed_import("pandas").read_csv(path, nrows=0).columns)
+
+
+@functools.lru_cache(maxsize=None)
+def _safety_checks():
+    """(verify source, restricted globals): the private helpers behind llama-index-experimental's safe_exec and
+    safe_eval, which refuse code objects and so can't run compiled code themselves"""
+    exec_utils = timed_import("llama_index.experimental.exec_utils")
+    try:
+        return exec_utils._verify_source_safety, exec_utils._get_restricted_globals
+    except AttributeError:
+        raise ImportError("this llama-index-experimental has no exec_utils._verify_source_safety / "
+                          "_get_restricted_globals to check generated code with; install the version "
+                          "requirements.txt pins") from None
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_instructions(output):
+    """Parser output checked and compiled the way PandasInstructionParser runs it, once per distinct output.
+
+    Returns (statements, expression) code objects, or None for a quoted last
+    line, which the parser evaluates into the expression to run.
+    """
+    verify, _ = _safety_checks()
+    tree = ast.parse(parse_code_markdown(output, only_last=True)[0])
+    statements = ast.unparse(ast.Module(tree.body[:-1], type_ignores=[]))
+    expression = ast.unparse(ast.Module(tree.body[-1:], type_ignores=[]))
+    if expression.strip("'\"") != expression:
+        return None
+    # The checks safe_exec and safe_eval make on each call; they won't take code objects, so it's done here
+    verify(statements)
+    verify(expression)
+    return compile(statements, "<string>", "exec"), compile(expression, "<string>", "eval")
+
+
+def run_in_memory(output, df, frames=None):
+    """What PandasInstructionParser(df).parse(output) returns, without parsing and compiling a repeated output again.
+
+    `frames` are other DataFrames the code may use, by variable name.
+    """
+    pd = timed_import("pandas")
+    try:
+        compiled = compile_instructions(output)
+        if compiled is None:
+            parser = timed_import("llama_index.experimental.query_engine.pandas").PandasInstructionParser
+            return parser(df).parse(output)
+        _, restricted_globals = _safety_checks()
+        statements, expression = compiled
+        local_vars = {**(frames or {}), "df": df, "pd": pd}
+        exec(statements, restricted_globals({}), local_vars)
+        return str(eval(expression, restricted_globals({"np": np}), local_vars))
+    except MemoryError:
+        raise
+    except Exception as e:
+        return ERROR_PREFIX + str(e)
+
+
+class ChunkedInstructionParser(ChainableOutputParser):
+    """Drop-in for PandasInstructionParser that streams large CSVs instead of loading them.
+
+    Small files, and expressions that can't be streamed, run as
+    PandasInstructionParser runs them, on the cached DataFrame. A large file
+    is only loaded for an expression of a shape that can't be streamed, never
+    because the expression is wrong: errors are reported the way the
+    in-memory parser reports them.
+    """
+
+    def __init__(self, path, others=None):
+        self.path = path
+        # Other CSVs the code may use: {variable name: path}
+        self.others = others or {}
+
+    def parse(self, output):
+        try:
+            # Code that doesn't parse, or fails the safety checks, is rejected before any data is read
+            compile_instructions(output)
+        except Exception as e:
+            return ERROR_PREFIX + str(e)
+        used = {node.id for node in ast.walk(ast.parse(parse_code_markdown(output, only_last=True)[0]))
+                if isinstance(node, ast.Name) and node.id in self.others}
+        if used:
+            # Only the frames the code names are loaded
+            frames = {name: load_dataframe(self.others[name]) for name in used}
+            return run_in_memory(output, load_dataframe(self.path), frames)
+        if is_large(self.path):
+            code, columns = parse_code_markdown(output, only_last=True)[0], tuple(header(self.path))
+            # A misspelt column fails in memory too, after reading the whole file
+            error = missing_column(code, columns)
+            if error is not None:
+                return ERROR_PREFIX + error
+            plan = plan_expression(code, columns)
+            if plan is not None:
+                try:
+                    with span("chunked_eval", parts=len(plan["terminals"]), columns=len(plan["columns"])):
+                        return str(run_plan(plan, self.path))
+                except NotStreamable:
+                    pass
+                except MemoryError:
+                    raise
+                except Exception as e:
+                    return ERROR_PREFIX + str(e)
+        return run_in_memory(output, load_dataframe(self.path))
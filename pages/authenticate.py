@@ -2,6 +2,7 @@ import streamlit as st
 import os
 import re
 from menu import menu, load_chats_from_firebase, generate_chat_id, save_chat_to_firebase
+from tracing import span
 from PIL import Image
 import pyrebase
 from datetime import datetime
@@ -112,7 +113,8 @@ with tab1:
         with st.spinner("Logging in..."):
             try:
                 # Authenticate with Firebase
-                user = auth.sign_in_with_email_and_password(email, password)
+                with span("firebase", op="sign_in"):
+                    user = auth.sign_in_with_email_and_password(email, password)
                 
                 # Store the user object with ID token for database operations
                 st.session_state.user = user
@@ -161,7 +163,8 @@ with tab2:
         with st.spinner("Creating account..."):
             try:
                 # Create user with Firebase Authentication
-                user = auth.create_user_with_email_and_password(email, password)
+                with span("firebase", op="sign_up"):
+                    user = auth.create_user_with_email_and_password(email, password)
                 
                 # Save auth token
                 st.session_state.user = user
@@ -177,7 +180,8 @@ with tab2:
                     }
                     
                     # Use authentication token for write operation
-                    db.child("users").child(user_id).set(user_data, user['idToken'])
+                    with span("firebase", op="create_user"):
+                        db.child("users").child(user_id).set(user_data, user['idToken'])
                     
                     # Create user directory structure
                     os.makedirs(f"{email}", exist_ok=True)
@@ -0,0 +1,75 @@
+import streamlit as st
+import pandas as pd
+from menu import menu
+from tracing import get_tracer, is_admin
+from index_cache import cache_stats
+from answer_cache import get_answer_cache
+from warmup import WARMUP, import_report
+from dataset_cache import dataset_cache_stats
+
+st.set_page_config(page_title="DORA", page_icon="🦙")
+st.markdown(f"""<style>
+        .st-emotion-cache-79elbk{{
+            display: none;}}
+            </style>""", unsafe_allow_html=True)
+menu()
+
+if "role" not in st.session_state or st.session_state.role is None:
+    st.switch_page('./pages/authenticate.py')
+
+# Spans name other users' projects and files: only the DORA_ADMINS list may look
+if not is_admin(st.session_state.role):
+    st.error("Only administrators can view the metrics.")
+    st.stop()
+
+tracer = get_tracer()
+
+st.header("Latency by stage")
+stages = tracer.stage_stats()
+if stages:
+    table = pd.DataFrame.from_dict(stages, orient="index")
+    for column in ("p50", "p95", "p99"):
+        table[column] = (table[column] * 1000).round(1)
+    table["total"] = table["total"].round(2)
+    st.dataframe(table.rename(columns={"p50": "p50 ms", "p95": "p95 ms", "p99": "p99 ms", "total": "total s"}))
+else:
+    st.write("Nothing traced yet in this server process.")
+
+with tracer.lock:
+    counters = dict(tracer.counters)
+if counters:
+    st.subheader("Counters")
+    st.dataframe(pd.Series(counters, name="value"))
+
+index_stats = cache_stats()
+answer_stats = get_answer_cache().stats()
+st.caption(f"Index cache: {index_stats['entries']} loaded, {index_stats['hits']} hits, {index_stats['misses']} misses. "
+           f"Answer cache: {answer_stats['entries']} entries, {answer_stats['hit_rate']:.0%} hit rate.")
+dataset_stats = dataset_cache_stats()
+st.caption(f"Dataset cache: {dataset_stats['entries']} loaded ({dataset_stats['bytes'] / 2 ** 20:.0f} MB), "
+           f"{dataset_stats['hits']} hits, {dataset_stats['misses']} misses.")
+
+st.subheader("Startup")
+imports = import_report()
+if imports:
+    st.dataframe(pd.DataFrame(imports, columns=["module", "seconds"]).round(3))
+    st.caption(f"First imports in this server process ({'preloaded in the background' if WARMUP else 'warm-up disabled'}); "
+               "page_setup above is the time a page rerun takes before handling a question.")
+else:
+    st.write("No heavy imports recorded yet.")
+
+st.subheader("Export")
+col1, col2 = st.columns([1, 1])
+with col1:
+    st.download_button("Prometheus snapshot", tracer.prometheus(), file_name="metrics.prom", mime="text/plain")
+with col2:
+    if st.button("Write snapshot to disk"):
+        st.success(f"Written to {tracer.write_snapshot()}")
+
+st.subheader("Recent spans")
+spans = tracer.recent_spans()
+if spans:
+    stage = st.selectbox("Stage:", options=["All"] + sorted({s["name"] for s in spans}))
+    rows = [{"stage": s["name"], "ms": round(s["duration"] * 1000, 1), "trace": s["trace_id"][:8], **s["attrs"]}
+            for s in spans if stage == "All" or s["name"] == stage]
+    st.dataframe(pd.DataFrame(rows))
@@ -1,12 +1,14 @@
 import streamlit as st
 import os
-import pptx
 import pyrebase
-import time
 from menu import menu
-from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, SummaryIndex
+from jobs import get_queue, progress_of
+from embed_cache import install_embedding_cache
+from tracing import span, install_tracing
 
 os.environ["OPENAI_API_KEY"] = st.secrets["openai"]
+embed_model = install_embedding_cache()
+install_tracing()
 
 firebaseConfig = {
     'apiKey': st.secrets["apiKey"],
@@ -37,6 +39,9 @@ if "projects" not in st.session_state:
 if "curr" not in st.session_state:
     st.session_state.curr = None
 
+if "announced_jobs" not in st.session_state:
+    st.session_state.announced_jobs = set()
+
 
 def create_project(project_name):
     if project_name not in st.session_state.projects:
@@ -49,23 +54,14 @@ def upload_and_store_files(file_uploads, target_folder):
     if not os.path.exists(target_folder):
         os.makedirs(target_folder)
 
-    for file_upload in file_uploads:
-        file_path = os.path.join(target_folder, file_upload.name)
-        
-        if file_path.endswith(".pptx"):
-            ppt = pptx.Presentation(file_upload)
-            text = []
-            for slide in ppt.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        text.append(shape.text)
-            with open(f'{target_folder}/{str(file_upload.name).split(".")[0]}.txt', "w") as f:
-                f.write("\n".join(text))
-        else:
+    # Text extraction (PPTX slides included) happens in the index build's extractor pipeline
+    with span("upload", files=len(file_uploads)) as attrs:
+        for file_upload in file_uploads:
+            file_path = os.path.join(target_folder, file_upload.name)
             with open(file_path, "wb") as f:
                 f.write(file_upload.getbuffer())
-        
-        file_paths.append(file_path)
+            file_paths.append(file_path)
+        attrs["bytes"] = sum(os.path.getsize(path) for path in file_paths)
 
     return file_paths
 def show_files(project_name):
@@ -78,14 +74,32 @@ def show_files(project_name):
             st.write("The project is empty.")
 
 
-
-def create_index(project_name):
-    docs = SimpleDirectoryReader(f"{st.session_state.role}/{project_name}").load_data()
-    index = VectorStoreIndex.from_documents(docs)
-    summary = SummaryIndex.from_documents(docs)
-
-    index.storage_context.persist(f'{st.session_state.role}/index/{project_name}')
-    summary.storage_context.persist(f'{st.session_state.role}/summary/{project_name}')
+@st.experimental_fragment(run_every=2)
+def show_jobs():
+    """Poll the background index builds of the current user"""
+    jobs = get_queue().jobs_for(st.session_state.role)[:5]
+    if not jobs:
+        return
+    st.subheader("Index builds")
+    for job in jobs:
+        if job["status"] in ("queued", "running"):
+            st.progress(progress_of(job), text=f"{job['project']}: {job['status']}")
+            with st.expander("Files", expanded=False):
+                for name, state in job["files"].items():
+                    st.write(f"--{name}: {state}")
+        elif job["status"] == "done":
+            stats = job["stats"]
+            st.write(f"{job['project']}: added {stats['added']}, updated {stats['updated']}, removed {stats['removed']}, unchanged {stats['unchanged']} files in {job['finished'] - job['started']:.1f}s.")
+            dedup = stats.get("dedup")
+            if dedup and dedup["chunks"]:
+                st.caption(f"{dedup['unique']} of {dedup['chunks']} chunks indexed, {dedup['duplicate_ratio']:.0%} were near-duplicates")
+            if job["id"] not in st.session_state.announced_jobs:
+                st.session_state.announced_jobs.add(job["id"])
+                st.toast("Index Creation Successful!", icon="🎉")
+        else:
+            st.error(f"{job['project']}: index build failed: {job['error']}")
+    cache = embed_model.store.stats()
+    st.caption(f"Embedding cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%} hit rate), {cache['entries']} vectors stored")
 
 
 st.header("Select or Create Project")
@@ -116,10 +130,10 @@ if process_button:
             else:
                 st.warning("No files uploaded.")
 
-        with st.spinner("Creating index... ⏳"):
-            create_index(project_name)
-            st.success("Index created! Navigate to the Query page to start querying.")
-            st.toast("Index Creation Successful!", icon="🎉")
+        get_queue().submit(st.session_state.role, project_name)
+        st.success("Index build started! You can keep working, the Query page is ready once it finishes.")
+
+show_jobs()
 
 st.write("Files in this project:")
 if project_name != "Create New Project":
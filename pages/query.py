@@ -1,11 +1,21 @@
 import streamlit as st
 import os
+import time
+page_start = time.perf_counter()
 from menu import menu, save_chat_to_firebase
-from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, SummaryIndex, StorageContext, load_index_from_storage
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core.chat_engine.context import ContextChatEngine
-from llama_index.llms.openai import OpenAI
-from llama_index.core.base.llms.types import ChatMessage
+from jobs import get_queue, progress_of
+from embed_cache import install_embedding_cache
+from index_cache import get_index, get_bm25, read_version
+from answer_cache import get_answer_cache, history_key
+from router import get_router
+from llama_index.core import Settings
+from bm25 import HybridRetriever, load_retrieval_config, save_retrieval_config
+from summary_tree import load_summary_tree, SummaryTreeRetriever
+from engine_pool import get_engine_pool
+from multi_project import MultiProjectRetriever, sources_of
+from subquestions import looks_compound, decompose, answer_subquestions, synthesize
+from tracing import span, get_tracer, install_tracing
+from warmup import timed_import
 from llama_index.core.prompts import PromptTemplate
 from typing import List
 
@@ -34,10 +44,20 @@ st.markdown(f"""<style>
             
             </style>""", unsafe_allow_html=True)
 menu()
+install_embedding_cache()
+install_tracing()
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# Time to first token and total generation time of every answered turn
+if "turn_timings" not in st.session_state:
+    st.session_state.turn_timings = []
+
+# Route chosen for every query, with the router's confidence and latency
+if "route_log" not in st.session_state:
+    st.session_state.route_log = []
+
 # Display chat title if it exists
 if "current_chat_title" in st.session_state and st.session_state.current_chat_title != "New Chat":
     st.subheader(f"Chat: {st.session_state.current_chat_title}")
@@ -58,11 +78,29 @@ for message in st.session_state.messages:
 
 gen_prompt = "Leverage your chatbot abilities to answer in detail some given questions on a specific topic by only using the context provided, not using any prior knowledge, making sure to avoid repetitions in the informations and write the answers in such a way that all the answers must follow the flow and together can be used to form a report."
 
+@st.experimental_fragment(run_every=2)
+def show_index_build(job_id):
+    """Poll the background build of the selected project's index, and reload the page once it is done"""
+    job = get_queue().get(job_id)
+    if job is None:
+        # Finished long ago and forgotten: the page picks up whatever it left on disk
+        st.rerun()
+    elif job["status"] in ("queued", "running"):
+        st.progress(progress_of(job), text=f"Building the index of {job['project']}: {job['status']}")
+    elif job["status"] == "done":
+        st.rerun()
+    else:
+        st.error(f"{job['project']}: index build failed: {job['error']}")
+
+
+index_job = None
 try: 
     projects_names = os.listdir(f"{st.session_state.role}/index")
     project_name = st.sidebar.selectbox("Select Project:", options=projects_names)
     st.sidebar.write(f"Selected Project: {project_name}")
     st.session_state.curr = project_name  # Save current project for chat history
+    # Related material in other projects is searched together with the selected one
+    other_projects = st.sidebar.multiselect("Also search in:", options=[p for p in projects_names if p != project_name])
     
     if os.path.exists(f'{st.session_state.role}/index/{project_name}'):
         if os.path.exists(f"{st.session_state.role}/{project_name}"):
@@ -73,26 +111,78 @@ try:
             else:
                 st.sidebar.write("The project is empty.")
     else:
-        docs = SimpleDirectoryReader(f"{st.session_state.role}/{project_name}").load_data()
-        index = VectorStoreIndex.from_documents(docs)
-        summary = SummaryIndex.from_documents(docs)
-        index.storage_context.persist(f'{st.session_state.role}/index/{project_name}')
-        summary.storage_context.persist(f'{st.session_state.role}/summary/{project_name}')
+        # Built in the background like uploads are, the page waits on it without blocking the server
+        index_job = get_queue().submit(st.session_state.role, project_name)
 
 except Exception as e:
     st.write("No Index Found.")
     st.stop()
 
-def format_chat_history_for_display(messages: List[dict], max_history=4):
+if index_job is not None:
+    show_index_build(index_job)
+    st.stop()
+
+# Per-project retrieval settings: keyword (BM25) search fused with vector search
+retrieval_config = load_retrieval_config(f'{st.session_state.role}/index/{project_name}')
+hybrid = st.sidebar.toggle("Keyword + semantic search", value=retrieval_config["hybrid"])
+alpha = st.sidebar.slider("Semantic weight", 0.0, 1.0, retrieval_config["alpha"], 0.05, disabled=not hybrid)
+if hybrid != retrieval_config["hybrid"] or alpha != retrieval_config["alpha"]:
+    retrieval_config = {**retrieval_config, "hybrid": hybrid, "alpha": alpha}
+    save_retrieval_config(f'{st.session_state.role}/index/{project_name}', retrieval_config)
+
+# Create a proper template object for text_qa_template with stronger emphasis on follow-up requests
+text_qa_template = PromptTemplate(
+    template="""
+    {gen_prompt}
+    
+    IMPORTANT: Pay close attention to any formatting, length, or style instructions in the question.
+    If asked for a short answer, brief summary, or specific word count, strictly adhere to those requirements.
+    
+    Only use the given context, do not add any prior knowledge.
+    Take into account our conversation history when answering.
+    
+    The given context: {context_str}
+    
+    Question: {query_str}
+    """.format(gen_prompt=gen_prompt, context_str="{context_str}", query_str="{query_str}")
+)
+
+system_prompt = (
+    f"{gen_prompt}\n"
+    "IMPORTANT: Pay close attention to any formatting, length, or style instructions in the question.\n"
+    "If asked for a short answer, brief summary, or specific word count, strictly adhere to those requirements.\n"
+    "Only use the given context, do not add any prior knowledge.\n"
+    "You are an AI assistant named DORA, not a person. If asked who you are, identify yourself as DORA, an AI assistant.\n"
+    "Take into account our conversation history when answering."
+)
+
+def format_chat_history_for_display(messages: List[dict]):
     """Format the chat history for display in the sidebar."""
-    # Get the last N messages
-    recent_messages = messages[-max_history:] if len(messages) > max_history else messages
     formatted_history = ""
-    for msg in recent_messages:
-        role = "Human" if msg["role"] == "user" else "Assistant"
+    for msg in messages:
+        # A summarized memory starts with a system message condensing the older turns
+        role = {"user": "Human", "system": "Summary"}.get(msg["role"], "Assistant")
         formatted_history += f"{role}: {msg['content']}\n\n"
     return formatted_history
 
+def timed_stream(tokens, timings, start):
+    """Pass tokens through, recording time to first token and total time since `start`"""
+    for token in tokens:
+        if "first_token" not in timings:
+            timings["first_token"] = time.perf_counter() - start
+        yield token
+    timings["total"] = time.perf_counter() - start
+    timings.setdefault("first_token", timings["total"])
+
+stream_answers = st.sidebar.toggle("Stream answers", value=True)
+# Multi-part questions are split, their parts answered concurrently, then combined
+split_questions = st.sidebar.toggle("Break down multi-part questions", value=True)
+
+
+def openai_llm(**kwargs):
+    # The OpenAI client is only imported once a question needs an LLM
+    return timed_import("llama_index.llms.openai").OpenAI(**kwargs)
+
 def query():
     query = st.chat_input(f"Enter Query:")
     if query:
@@ -100,81 +190,173 @@ def query():
         with st.chat_message("user"):
             st.markdown(query)
         
-        # Choose the right index based on the query
-        if "summary" in query.lower() or "short note" in query.lower() or "tldr" in query.lower() or "tl;dr" in query.lower():
-            storage_context = StorageContext.from_defaults(persist_dir=f'{st.session_state.role}/summary/{project_name}')
-            index = load_index_from_storage(storage_context)
-        else:
-            storage_context = StorageContext.from_defaults(persist_dir=f'{st.session_state.role}/index/{project_name}')
-            index = load_index_from_storage(storage_context)
-        
-        # Get recent chat history (last 4 conversations)
-        recent_messages = st.session_state.messages[:-1]
-        max_history = 4
-        if len(recent_messages) > max_history:
-            recent_messages = recent_messages[-max_history:]
-        
-        # Format chat history for display
-        chat_history_display = format_chat_history_for_display(recent_messages)
-        
-        # Initialize the LLM with OpenAI
-        llm = OpenAI(temperature=0.1)  # Lower temperature for more consistent responses
-        
-        # Create memory with recent chat history
-        memory = ChatMemoryBuffer.from_defaults(token_limit=500000)
-        
-        # Add previous messages to memory using ChatMessage
-        for msg in recent_messages:
-            if msg["role"] == "user":
-                memory.put(ChatMessage(role="user", content=msg["content"]))
-            elif msg["role"] == "assistant":
-                memory.put(ChatMessage(role="assistant", content=msg["content"]))
-        
-        # Create a proper template object for text_qa_template with stronger emphasis on follow-up requests
-        text_qa_template = PromptTemplate(
-            template="""
-            {gen_prompt}
-            
-            IMPORTANT: Pay close attention to any formatting, length, or style instructions in the question.
-            If asked for a short answer, brief summary, or specific word count, strictly adhere to those requirements.
-            
-            Only use the given context, do not add any prior knowledge.
-            Take into account our conversation history when answering.
-            
-            The given context: {context_str}
-            
-            Question: {query_str}
-            """.format(gen_prompt=gen_prompt, context_str="{context_str}", query_str="{query_str}")
-        )
-        
-        # Update the query engine with custom instructions using the proper template
-        query_engine = index.as_query_engine(
-            similarity_top_k=3,
-            text_qa_template=text_qa_template
-        )
-                
-        # Create a regular chat engine with memory instead of CondenseQuestionChatEngine
-        chat_engine = ContextChatEngine.from_defaults(
-            retriever=query_engine,
-            chat_history=recent_messages,
-            memory=memory,
-            system_prompt=(
-                f"{gen_prompt}\n"
-                "IMPORTANT: Pay close attention to any formatting, length, or style instructions in the question.\n"
-                "If asked for a short answer, brief summary, or specific word count, strictly adhere to those requirements.\n"
-                "Only use the given context, do not add any prior knowledge.\n"
-                "You are an AI assistant named DORA, not a person. If asked who you are, identify yourself as DORA, an AI assistant.\n"
-                "Take into account our conversation history when answering."
-            ),
-            llm=llm,
-            verbose=True  # Enable verbose mode for debugging
-        )
+        with span("query") as trace:
+            # Choose the right index based on the query: the router compares the query
+            # embedding (needed for retrieval and the answer cache anyway) with labelled examples
+            start = time.perf_counter()
+            query_embedding = Settings.embed_model.get_query_embedding(query)
+            has_csv = any(file.endswith(".csv") for file in os.listdir(f"{st.session_state.role}/{project_name}"))
+            # Across projects only chunk retrieval applies, summaries and datasets are per project
+            if other_projects:
+                allowed_routes = ("vector",)
+            else:
+                allowed_routes = None if has_csv else ("vector", "summary")
+            route, route_confidence = get_router().route(query_embedding, allowed=allowed_routes)
+            route_time = time.perf_counter() - start
+            trace["route"] = route
+            st.session_state.route_log.append({"query": query, "route": route,
+                                               "confidence": route_confidence, "latency": route_time})
+
+            if route == "dataset":
+                # Dataset questions go to the Data Analysis page, which picks the query up on load
+                st.session_state.pending_dataset_query = {"query": query, "project": project_name}
+                st.switch_page("./pages/visualize.py")
+
+            # Summary-style queries are answered from the precomputed summary tree
+            # when the project has one, otherwise from the full summary index
+            tree = None
+            if route == "summary":
+                index_kind = "summary"
+                tree = load_summary_tree(st.session_state.role, project_name)
+                if tree is None:
+                    index = get_index(f'{st.session_state.role}/summary/{project_name}')
+            else:
+                index_kind = "index"
+                index = get_index(f'{st.session_state.role}/index/{project_name}')
         
-        with st.chat_message("assistant"):
-            with st.spinner("Grabbing the answers..."):
-                response = chat_engine.chat(query)
-                st.markdown(response.response)
-                st.session_state.messages.append({"role": "assistant", "content": response.response})
+            # The chat's LLM, memory and engines live in a process-wide pool across turns;
+            # the memory only needs the messages it hasn't seen yet
+            session = get_engine_pool().session(
+                (st.session_state.role, project_name, st.session_state.current_chat_id),
+                lambda: openai_llm(temperature=0.1),  # Lower temperature for more consistent responses
+            )
+            session.sync(st.session_state.messages[:-1])
+
+            # The history the engine answers from, trimmed to its token budget, also scopes the
+            # answer cache and is what question splitting and synthesis see
+            history = session.history()
+            chat_history_display = format_chat_history_for_display(history)
+
+            # Near-duplicates of an earlier question (same project version, route and history) reuse its answer
+            answer_cache = get_answer_cache()
+            projects = [project_name] + other_projects
+            cache_scope = f"{st.session_state.role}/{'+'.join(projects)}|{index_kind}|{tree is not None}|{hybrid}|{alpha}"
+            cache_version = "+".join(read_version(f'{st.session_state.role}/{index_kind}/{p}') for p in projects)
+            if tree is not None:
+                # The tree is rebuilt after the indexes are versioned: answers from it carry its own stamp
+                cache_version += "|tree:" + (tree.get("project") or {}).get("key", "")
+            cache_history = history_key(history)
+            cached_answer = answer_cache.lookup(cache_scope, cache_version, cache_history, query_embedding)
+            if cached_answer is not None:
+                with st.chat_message("assistant"):
+                    st.markdown(cached_answer)
+                    elapsed = time.perf_counter() - start
+                    st.session_state.messages.append({"role": "assistant", "content": cached_answer})
+                    st.session_state.turn_timings.append({"cached": True, "first_token": elapsed, "total": elapsed})
+                    st.caption(f"Answered from cache in {elapsed * 1000:.0f}ms")
+                    trace["cached"] = True
+                return
+
+            def project_retriever(name):
+                persist_dir = f'{st.session_state.role}/index/{name}'
+                bm25 = get_bm25(persist_dir) if hybrid else None
+                if bm25 is not None:
+                    return HybridRetriever(get_index(persist_dir), bm25, similarity_top_k=3, alpha=alpha)
+                return get_index(persist_dir).as_retriever(similarity_top_k=3)
+
+            def make_retriever():
+                if tree is not None:
+                    return SummaryTreeRetriever(tree)
+                if other_projects:
+                    return MultiProjectRetriever({name: lambda name=name: project_retriever(name) for name in projects})
+                bm25 = get_bm25(f'{st.session_state.role}/index/{project_name}') if index_kind == "index" else None
+                if hybrid and bm25 is not None:
+                    return HybridRetriever(index, bm25, similarity_top_k=3, alpha=alpha)
+                # Update the query engine with custom instructions using the proper template
+                return index.as_query_engine(
+                    similarity_top_k=3,
+                    text_qa_template=text_qa_template
+                )
+
+            # Summary tree sections are already condensed, and the summary index answers from
+            # every node by design: only chunks retrieved from the vector index are compressed
+            route_key = (cache_version, cache_scope)
+            chat_engine = session.engine(route_key, make_retriever, system_prompt, compress=index_kind == "index")
+            setup_time = time.perf_counter() - start
+            history_tokens = session.history_tokens()
+
+            subquestions = None
+            if split_questions and route == "vector" and looks_compound(query):
+                with st.spinner("Reading the question..."):
+                    decompose_start = time.perf_counter()
+                    subquestions = decompose(query, session.llm, chat_history_display)
+                    decompose_time = time.perf_counter() - decompose_start
+            if subquestions and len(subquestions) > 1:
+                trace["subquestions"] = len(subquestions)
+                if other_projects:
+                    retriever = MultiProjectRetriever({name: lambda name=name: project_retriever(name) for name in projects})
+                else:
+                    retriever = project_retriever(project_name)
+                with st.chat_message("assistant"):
+                    timings = {"streamed": True}
+                    start = time.perf_counter()
+                    with st.spinner(f"Answering {len(subquestions)} sub-questions..."):
+                        # A client per call: asyncio.run gives every turn a fresh event loop
+                        results = answer_subquestions(subquestions, retriever, openai_llm(temperature=0.1, reuse_client=False))
+                    parallel_time = time.perf_counter() - start
+                    with st.expander(f"Answered as {len(results)} sub-questions", expanded=False):
+                        for r in results:
+                            st.markdown(f"**{r['question']}**  \n{r['answer']}")
+                            st.caption(f"retrieval {r['retrieve'] * 1000:.0f}ms, LLM {r['llm']:.2f}s, waited {r['wait']:.2f}s")
+                    answer = st.write_stream(timed_stream(
+                        synthesize(query, results, session.llm, system_prompt, chat_history_display), timings, start))
+                    st.session_state.messages.append({"role": "assistant", "content": answer})
+                    session.record_turn(query, answer)
+                    session.synced = len(st.session_state.messages)
+                    timings.update(setup=setup_time, history_tokens=history_tokens, route=route, route_time=route_time,
+                                   decompose=decompose_time, subquestions_wall=parallel_time,
+                                   subquestions=[{k: r[k] for k in ("question", "wait", "retrieve", "llm", "total")}
+                                                 for r in results])
+                    st.session_state.turn_timings.append(timings)
+                    answer_cache.store(cache_scope, cache_version, cache_history, query_embedding, answer)
+                    slowest = max(r["total"] for r in results)
+                    st.caption(f"{len(results)} sub-questions in {parallel_time:.2f}s (slowest {slowest:.2f}s, "
+                               f"sum {sum(r['total'] for r in results):.2f}s), answered in {timings['total']:.2f}s")
+                return
+
+            with st.chat_message("assistant"):
+                timings = {"streamed": stream_answers}
+                start = time.perf_counter()
+                if stream_answers:
+                    with st.spinner("Grabbing the answers..."):
+                        # Returns once retrieval is done, tokens then arrive as they are generated
+                        response = chat_engine.stream_chat(query)
+                    answer = st.write_stream(timed_stream(response.response_gen, timings, start))
+                else:
+                    with st.spinner("Grabbing the answers..."):
+                        response = chat_engine.chat(query)
+                        answer = response.response
+                        timings["total"] = timings["first_token"] = time.perf_counter() - start
+                        st.markdown(answer)
+                st.session_state.messages.append({"role": "assistant", "content": answer})
+                # The engine already wrote this turn into the memory
+                session.synced = len(st.session_state.messages)
+                context_stats = session.context_stats(route_key)
+                timings.update(setup=setup_time, history_tokens=history_tokens, route=route, route_time=route_time,
+                               context_tokens_saved=context_stats.get("tokens_saved", 0))
+                st.session_state.turn_timings.append(timings)
+                answer_cache.store(cache_scope, cache_version, cache_history, query_embedding, answer)
+                st.caption(f"First token after {timings['first_token']:.2f}s, answered in {timings['total']:.2f}s "
+                           f"(setup {setup_time * 1000:.0f}ms, {history_tokens} history tokens"
+                           + (f", context {context_stats['tokens_before']} -> {context_stats['tokens_after']} tokens"
+                              if context_stats else "") + ")")
+                if other_projects:
+                    sources = sources_of(response.source_nodes)
+                    st.caption("Sources: " + ", ".join(f"{name} ({count})" for name, count in sources.items()))
+
+get_tracer().record("page_setup", time.perf_counter() - page_start, page="query")
+stats = get_answer_cache().stats()
+st.sidebar.caption(f"Answer cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
 
 if __name__ == "__main__":
     query()
\ No newline at end of file
@@ -1,22 +1,17 @@
 import streamlit as st
 import os
+import time
+import threading
 from menu import menu
-import pandas as pd
-from lida import Manager, TextGenerationConfig, llm
-from PIL import Image
 from io import BytesIO
 import base64
-import matplotlib.pyplot as plt
-from llama_index.core.query_pipeline import (
-    QueryPipeline as QP,
-    Link,
-    InputComponent,
-)
-from llama_index.experimental.query_engine.pandas import (
-    PandasInstructionParser,
-)
-from llama_index.llms.openai import OpenAI
-from llama_index.core import PromptTemplate
+from tracing import span, get_tracer, install_tracing
+from warmup import timed_import
+from lida_summaries import get_summary, lida_frame
+
+# pandas, LIDA, PIL and llama-index are imported on the code paths that use them:
+# most reruns (sidebar clicks, chat history) need none of them
+page_start = time.perf_counter()
 
 
 st.set_page_config(page_title="DORA", page_icon="🦙")
@@ -25,6 +20,7 @@ st.markdown(f"""<style>
             display: none;}}
             </style>""", unsafe_allow_html=True)
 menu()
+install_tracing()
 
 
 if "messages" not in st.session_state:
@@ -39,7 +35,7 @@ def base64_to_image(base64_string):
             base64_string = base64_string.split(',')[1]
             
         image_data = base64.b64decode(base64_string)
-        return Image.open(BytesIO(image_data))
+        return timed_import("PIL.Image").open(BytesIO(image_data))
     except Exception as e:
         st.error(f"Error converting base64 to image: {e}")
         return None
@@ -89,8 +85,9 @@ instruction_str = (
 pandas_prompt_str = (
     "You are working with a pandas dataframe in Python.\n"
     "The name of the dataframe is `df`.\n"
-    "This is the result of `print(df.head())`:\n"
+    "This is a profile of its columns (type, missing and distinct values, range, most common values):\n"
     "{df_str}\n\n"
+    "{others_str}"
     "Follow these instructions:\n"
     "{instruction_str}\n"
     "Query: {query_str}\n\n"
@@ -107,28 +104,53 @@ response_synthesis_prompt_str = (
 def image_to_base64(image):
     """Convert PIL image to base64 string"""
     buffered = BytesIO()
-    if isinstance(image, Image.Image):
+    if isinstance(image, timed_import("PIL.Image").Image):
         image.save(buffered, format="PNG")
         return base64.b64encode(buffered.getvalue()).decode("utf-8")
     else:
         # If it's already a base64 string or other format, return as is
         return image
 
-# Initialize LIDA manager
-lida = Manager(text_gen=llm("openai"))
-text_gen_config = TextGenerationConfig(n=1, temperature=0.1, model="gpt-4o-mini", use_cache=False)
+@st.cache_resource(show_spinner=False)
+def get_lida_llm():
+    """LIDA's LLM client and generation config, created once per server (neither keeps per-request state)"""
+    lida = timed_import("lida")
+    return lida.llm("openai"), lida.TextGenerationConfig(n=1, temperature=0.1, model="gpt-4o-mini", use_cache=False)
+
+
+def new_lida():
+    """A LIDA manager for one request: summarize() and visualize() keep the dataset on it, so it can't be shared"""
+    text_gen, text_gen_config = get_lida_llm()
+    return timed_import("lida").Manager(text_gen=text_gen), text_gen_config
+
+
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    return timed_import("llama_index.llms.openai").OpenAI(model="gpt-4o-mini")
 
 try: 
-    project_name = st.sidebar.selectbox("Select Project:", options=st.session_state.projects)
+    # A dataset question routed here from the Query page opens on that page's project
+    project_options = list(st.session_state.get("projects", []))
+    pending = st.session_state.get("pending_dataset_query")
+    if pending and pending["project"] not in project_options:
+        project_options.append(pending["project"])
+    project_name = st.sidebar.selectbox("Select Project:", options=project_options,
+                                        index=project_options.index(pending["project"]) if pending else 0)
     st.sidebar.write(f"Selected Project: {project_name}")
     if os.path.exists(f"{st.session_state.role}/{project_name}"):
         files = os.listdir(f"{st.session_state.role}/{project_name}")
         if files:
             csv_files = [file for file in files if file.endswith('.csv')]
             if csv_files:
-                for file in csv_files:
-                    st.sidebar.write(file)
-                filename = csv_files[0]  # Default to first CSV file
+                # Automatic picks the CSV each question is about from the project's catalog
+                dataset_choice = st.sidebar.radio("Dataset:", options=["Automatic"] + csv_files)
+                filename = csv_files[0] if dataset_choice == "Automatic" else dataset_choice
+                # Start the analysis workers and load the dataset into them while the user types
+                if st.session_state.get("sandbox_preloaded") != (project_name, filename):
+                    st.session_state.sandbox_preloaded = (project_name, filename)
+                    preload_path = f"{st.session_state.role}/{project_name}/{filename}"
+                    threading.Thread(target=lambda: timed_import("sandbox").get_sandbox().preload(preload_path),
+                                     name="sandbox-preload", daemon=True).start()
             else:
                 st.sidebar.write("No CSV files found.")
                 st.stop()
@@ -140,106 +162,164 @@ except Exception as e:
     st.write(f"No Dataset Found: {str(e)}")
     st.stop()
 
-llm = OpenAI(model="gpt-4o-mini")
+get_tracer().record("page_setup", time.perf_counter() - page_start, page="visualize")
+
+
 
 
+def choose_dataset(query, csv_files, catalog, trace):
+    """Name and path of the CSV a question is about (the sidebar choice, or the catalog's best match),
+    and the other CSVs that match it too, as {variable name: file name}"""
+    from catalog import rank_datasets, frame_name
+    matches = rank_datasets(query, catalog) if dataset_choice == "Automatic" else []
+    filename = dataset_choice if dataset_choice != "Automatic" else (matches[0] if matches else csv_files[0])
+    others = {}
+    for name in matches:
+        if name != filename and frame_name(name) not in others:
+            others[frame_name(name)] = name
+    trace["dataset"] = filename
+    trace["other_datasets"] = len(others)
+    if len(csv_files) > 1:
+        st.caption(f"Using {filename}" + (f" (and {', '.join(others.values())})" if others else ""))
+    return filename, f"{st.session_state.role}/{project_name}/{filename}", others
 
 
 def visualize():
 
         
     query = st.chat_input(f"Enter Query:")
+    pending = st.session_state.pop("pending_dataset_query", None)
     if query:
         st.session_state.messages.append({"role": "user", "content": query})
         with st.chat_message("user"):
             st.markdown(query)
+    elif pending:
+        # Routed here from the Query page, which already logged and showed the question
+        query = pending["query"]
+
+    if query:
+        with span("visualize") as trace:
+            # Find a CSV file in the project directory
+            csv_files = [file for file in files if file.endswith('.csv')]
+            if not csv_files:
+                st.error("No CSV files found in the project directory")
+                return
             
-        # Find a CSV file in the project directory
-        csv_files = [file for file in files if file.endswith('.csv')]
-        if not csv_files:
-            st.error("No CSV files found in the project directory")
-            return
-            
-        filename = csv_files[0]  # Use the first CSV file
-        file_path = f"{st.session_state.role}/{project_name}/{filename}"
-        
-        with st.chat_message("assistant"):
-            with st.spinner("Analyzing data..."):
-                if any(keyword in query.lower() for keyword in ['plot', 'graph', 'chart', 'visual', 'visualization']):
-                    # Generate visualization
-                    try:
-                        summary = lida.summarize(file_path, summary_method="default", textgen_config=text_gen_config)
-                        charts = lida.visualize(summary=summary, goal=query, textgen_config=text_gen_config)
+            with st.chat_message("assistant"):
+                with st.spinner("Analyzing data..."):
+                    if any(keyword in query.lower() for keyword in ['plot', 'graph', 'chart', 'visual', 'visualization']):
+                        # Generate visualization
+                        try:
+                            trace["kind"] = "chart"
+                            from catalog import load_catalog
+                            # Charts don't use the profiles: pick from the stored catalog without profiling anything
+                            # LIDA plots one dataset, the best match
+                            filename, file_path, _ = choose_dataset(
+                                query, csv_files, load_catalog(st.session_state.role, project_name), trace)
+                            lida, text_gen_config = new_lida()
+                            # LIDA calls its own LLM client, so its calls are timed here
+                            data = lida_frame(file_path)
+                            summary, saved = get_summary(st.session_state.role, project_name, filename,
+                                                         lida.text_gen, text_gen_config, data)
+                            # visualize() runs the chart code on the data summarize() would have read;
+                            # the manager is this request's own, so no other session sees this frame
+                            lida.data = data
+                            trace["summary_cached"] = saved is not None
+                            trace["summary_seconds_saved"] = saved or 0.0
+                            with span("lida_visualize"):
+                                charts = lida.visualize(summary=summary, goal=query, textgen_config=text_gen_config)
                         
-                        if charts and len(charts) > 0:
-                            # Get the first chart
-                            chart = charts[0]
+                            if charts and len(charts) > 0:
+                                # Get the first chart
+                                chart = charts[0]
                             
-                            # Display the chart directly
-                            st.image(base64_to_image(chart.raster), caption='Visualization')
+                                # Display the chart directly
+                                st.image(base64_to_image(chart.raster), caption='Visualization')
                             
-                            # Store the entire chart object for later retrieval
+                                # Store the entire chart object for later retrieval
+                                st.session_state.messages.append({
+                                    "role": "assistant", 
+                                    "content": chart.raster,
+                                    "is_image": True,
+                                    "image_type": "lida_chart"  # Add this to indicate the type of image
+                                })
+                            else:
+                                st.warning("No visualizations could be generated")
+                                st.session_state.messages.append({
+                                    "role": "assistant",
+                                    "content": "I couldn't generate a visualization for this query. Could you provide more specific instructions?",
+                                })
+                        except Exception as e:
+                            st.error(f"Error generating visualization: {str(e)}")
+                            st.session_state.messages.append({
+                                "role": "assistant",
+                                "content": f"Sorry, I encountered an error while generating the visualization: {str(e)}",
+                            })
+                    else:
+                        # Handle regular data queries
+                        try:
+                            trace["kind"] = "pandas"
+                            from catalog import update_catalog, profile_text
+                            # Profiles are computed at upload; this only profiles files changed since
+                            catalog = update_catalog(st.session_state.role, project_name)
+                            filename, file_path, others = choose_dataset(query, csv_files, catalog, trace)
+                            from llama_index.core import PromptTemplate
+                            from llama_index.core.query_pipeline import QueryPipeline as QP, Link, InputComponent
+                            from sandbox import SandboxedInstructionParser
+                            llm = get_llm()
+                            # Large CSVs are streamed in chunks when the expression allows it,
+                            # others are parsed once per file and shared by every session
+                            # A profile of every column tells the LLM more than the first rows, in fewer tokens
+                            # Other CSVs the question matches are there as their own dataframes
+                            others_str = "".join(
+                                f"The dataframe `{name}` ({other}) is also available:\n"
+                                f"{profile_text(catalog[other]['profile'])}\n\n"
+                                for name, other in others.items()
+                            )
+                            pandas_prompt = PromptTemplate(pandas_prompt_str).partial_format(
+                                instruction_str=instruction_str, df_str=profile_text(catalog[filename]["profile"]),
+                                others_str=others_str,
+                            )
+                            # Generated code runs in a worker process, with a timeout and a memory cap
+                            pandas_output_parser = SandboxedInstructionParser(file_path, {
+                                name: f"{st.session_state.role}/{project_name}/{other}" for name, other in others.items()
+                            })
+                            response_synthesis_prompt = PromptTemplate(response_synthesis_prompt_str)
+
+                            qp = QP(
+                                modules={
+                                    "input": InputComponent(),
+                                    "pandas_prompt": pandas_prompt,
+                                    "llm1": llm,
+                                    "pandas_output_parser": pandas_output_parser,
+                                    "response_synthesis_prompt": response_synthesis_prompt,
+                                    "llm2": llm,
+                                },
+                                verbose=True,
+                            )
+                            qp.add_chain(["input", "pandas_prompt", "llm1", "pandas_output_parser"])
+                            qp.add_links(
+                                [
+                                    Link("input", "response_synthesis_prompt", dest_key="query_str"),
+                                    Link("llm1", "response_synthesis_prompt", dest_key="pandas_instructions"),
+                                    Link("pandas_output_parser", "response_synthesis_prompt", dest_key="pandas_output"),
+                                ]
+                            )
+                            qp.add_link("response_synthesis_prompt", "llm2")
+                        
+                            with span("pandas_pipeline"):
+                                response = qp.run(query_str=query)
+                            st.markdown(response.message.content)
                             st.session_state.messages.append({
                                 "role": "assistant", 
-                                "content": chart.raster,
-                                "is_image": True,
-                                "image_type": "lida_chart"  # Add this to indicate the type of image
+                                "content": response.message.content
                             })
-                        else:
-                            st.warning("No visualizations could be generated")
+                        except Exception as e:
+                            st.error(f"Error analyzing data: {str(e)}")
                             st.session_state.messages.append({
                                 "role": "assistant",
-                                "content": "I couldn't generate a visualization for this query. Could you provide more specific instructions?",
+                                "content": f"Sorry, I encountered an error while analyzing the data: {str(e)}",
                             })
-                    except Exception as e:
-                        st.error(f"Error generating visualization: {str(e)}")
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": f"Sorry, I encountered an error while generating the visualization: {str(e)}",
-                        })
-                else:
-                    # Handle regular data queries
-                    try:
-                        df = pd.read_csv(file_path)
-                        pandas_prompt = PromptTemplate(pandas_prompt_str).partial_format(
-                            instruction_str=instruction_str, df_str=df.head(5)
-                        )
-                        pandas_output_parser = PandasInstructionParser(df)
-                        response_synthesis_prompt = PromptTemplate(response_synthesis_prompt_str)
-
-                        qp = QP(
-                            modules={
-                                "input": InputComponent(),
-                                "pandas_prompt": pandas_prompt,
-                                "llm1": llm,
-                                "pandas_output_parser": pandas_output_parser,
-                                "response_synthesis_prompt": response_synthesis_prompt,
-                                "llm2": llm,
-                            },
-                            verbose=True,
-                        )
-                        qp.add_chain(["input", "pandas_prompt", "llm1", "pandas_output_parser"])
-                        qp.add_links(
-                            [
-                                Link("input", "response_synthesis_prompt", dest_key="query_str"),
-                                Link("llm1", "response_synthesis_prompt", dest_key="pandas_instructions"),
-                                Link("pandas_output_parser", "response_synthesis_prompt", dest_key="pandas_output"),
-                            ]
-                        )
-                        qp.add_link("response_synthesis_prompt", "llm2")
-                        
-                        response = qp.run(query_str=query)
-                        st.markdown(response.message.content)
-                        st.session_state.messages.append({
-                            "role": "assistant", 
-                            "content": response.message.content
-                        })
-                    except Exception as e:
-                        st.error(f"Error analyzing data: {str(e)}")
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": f"Sorry, I encountered an error while analyzing the data: {str(e)}",
-                        })
 
 if __name__ == "__main__":
     visualize()
\ No newline at end of file
@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from llama_index.core import Settings
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+# Below this similarity to the closest exemplar we don't trust the route and use DEFAULT_ROUTE
+ROUTE_THRESHOLD = float(os.environ.get("DORA_ROUTE_THRESHOLD", 0.45))
+DEFAULT_ROUTE = "vector"
+
+# Labelled example queries for every route
+ROUTE_EXEMPLARS = {
+    "vector": [
+        "What is the refund policy?",
+        "Who signed the contract?",
+        "What does clause 4.2 say about termination?",
+        "When is the delivery deadline?",
+        "Which part number is used for the pump?",
+        "How do I reset the device?",
+        "What are the risks mentioned in the report?",
+        "Explain the methodology used in chapter 3",
+        "What is the price of the premium plan?",
+        "List the requirements for the application",
+    ],
+    "summary": [
+        "Give me a summary of the documents",
+        "Summarize this project",
+        "tl;dr",
+        "Give me an overview of everything",
+        "What are these documents about?",
+        "Write a short note on the uploaded files",
+        "What are the main points overall?",
+        "Summarize the report in a few paragraphs",
+        "Give me the gist of the presentation",
+        "Brief me on the whole project",
+    ],
+    "dataset": [
+        "What is the average value of the sales column?",
+        "Give me summary statistics of column price",
+        "How many rows are in the dataset?",
+        "Plot revenue by month",
+        "Show a bar chart of the top 10 products",
+        "What is the correlation between age and income?",
+        "Which category has the highest total?",
+        "Group the data by region and count the records",
+        "What is the maximum temperature in the table?",
+        "Draw a histogram of the scores",
+    ],
+}
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+class QueryRouter:
+    """Picks a route for a query by its nearest labelled exemplars.
+
+    The exemplars are embedded once per process (and by the embedding cache
+    across restarts); routing a query then costs one matrix-vector product on
+    the query embedding that retrieval needs anyway.
+    """
+
+    def __init__(self, exemplars=None, threshold=ROUTE_THRESHOLD, embed_model=None):
+        self.exemplars = exemplars or ROUTE_EXEMPLARS
+        self.threshold = threshold
+        self.embed_model = embed_model
+        self.matrix = None
+        self.labels = None
+        self.lock = threading.Lock()
+
+    def _ensure_embedded(self):
+        with self.lock:
+            if self.matrix is None:
+                texts, labels = [], []
+                for route, examples in self.exemplars.items():
+                    texts += examples
+                    labels += [route] * len(examples)
+                embed_model = self.embed_model or Settings.embed_model
+                self.matrix = _normalize(embed_model.get_text_embedding_batch(texts))
+                self.labels = np.array(labels)
+
+    def route(self, query_embedding, allowed=None):
+        """(route, confidence) for a query embedding, restricted to the `allowed` routes if given"""
+        start = time.perf_counter()
+        self._ensure_embedded()
+        scores = self.matrix @ _normalize(query_embedding)
+        best = {}
+        for route in self.exemplars:
+            if allowed is not None and route not in allowed:
+                continue
+            route_scores = scores[self.labels == route]
+            # Mean of the top 3 is steadier than the single closest exemplar
+            best[route] = float(np.sort(route_scores)[-3:].mean())
+        route = max(best, key=best.get)
+        confidence = best[route]
+        if confidence < self.threshold:
+            route = DEFAULT_ROUTE
+        latency = time.perf_counter() - start
+        logger.info("route=%s confidence=%.3f scores=%s latency_ms=%.2f", route, confidence,
+                    {k: round(v, 3) for k, v in best.items()}, latency * 1000)
+        get_tracer().record("route", latency, route=route, confidence=round(confidence, 3))
+        return route, confidence
+
+
+_router = None
+
+
+def get_router():
+    """The process-wide router, embedded on first use"""
+    global _router
+    if _router is None:
+        _router = QueryRouter()
+    return _router
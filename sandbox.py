@@ -0,0 +1,199 @@
+"""Runs LLM-generated pandas expressions in separate worker processes.
+
+A runaway expression (a cross join, a huge groupby) only takes down its
+worker: it is killed after a timeout, or hits its memory cap, and is
+replaced, while the Streamlit server and the other sessions carry on.
+Workers start with pandas and the parsers already imported and keep their
+own dataset cache, so a question costs no imports and, after the first one
+on a file, no CSV parsing.
+"""
+import os
+import time
+import threading
+import multiprocessing
+from llama_index.core.output_parsers import ChainableOutputParser
+from out_of_core import ERROR_PREFIX
+from tracing import get_tracer
+
+SANDBOX_WORKERS = int(os.environ.get("DORA_SANDBOX_WORKERS", 2))
+SANDBOX_TIMEOUT = float(os.environ.get("DORA_SANDBOX_TIMEOUT", 30))
+# Memory a worker may allocate on top of what it uses when idle (memory-mapped datasets don't count)
+SANDBOX_MEMORY_BYTES = int(os.environ.get("DORA_SANDBOX_MEMORY_MB", 4096)) * 1024 * 1024
+# Time a new worker may take to import pandas and the parsers
+STARTUP_TIMEOUT = float(os.environ.get("DORA_SANDBOX_STARTUP_TIMEOUT", 120))
+# Longer results are cut before they reach the response prompt
+MAX_RESULT_CHARS = int(os.environ.get("DORA_SANDBOX_MAX_RESULT_CHARS", 20000))
+
+
+def _limit_memory(extra_bytes):
+    """Cap the process's private memory at its current size plus `extra_bytes` (Linux only)"""
+    try:
+        import resource
+        with open("/proc/self/status") as f:
+            current = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmData:"))
+        resource.setrlimit(resource.RLIMIT_DATA, (current + extra_bytes, resource.getrlimit(resource.RLIMIT_DATA)[1]))
+    except (ImportError, OSError, StopIteration, ValueError):
+        # No cap where the platform can't set one; the timeout still applies
+        pass
+
+
+def _worker_main(conn, memory_bytes):
+    # Warm up before the first request: these imports are most of a cold run
+    from out_of_core import ChunkedInstructionParser
+    from warmup import timed_import
+    try:
+        timed_import("llama_index.experimental.query_engine.pandas")
+    except ImportError:
+        # Only the in-memory fallback needs it, and reports the error itself
+        pass
+    _limit_memory(memory_bytes)
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            message = conn.recv()
+            # Preloads still queued when a run arrives are dropped, they'd only count against its timeout
+            while message[0] == "load" and conn.poll():
+                message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] == "load":
+            try:
+                from out_of_core import is_large
+                from dataset_cache import load_dataframe
+                # Large files are streamed per query, never held whole
+                if not is_large(message[1]):
+                    load_dataframe(message[1])
+            except Exception:
+                pass
+            continue
+        _, path, output, others = message
+        start = time.perf_counter()
+        try:
+            text = ChunkedInstructionParser(path, others).parse(output)
+        except MemoryError:
+            text = ERROR_PREFIX + "the expression needed more memory than a query may use"
+        except Exception as e:
+            text = ERROR_PREFIX + str(e)
+        conn.send((text, time.perf_counter() - start))
+
+
+class _Worker:
+    def __init__(self, context, memory_bytes):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, memory_bytes),
+                                       name="dora-sandbox", daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        """Wait for the worker to finish warming up, so its start-up doesn't count against a query's timeout"""
+        if not self.ready and self.conn.poll(timeout):
+            self.ready = self.conn.recv()[0] == "ready"
+        return self.ready
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class SandboxPool:
+    """A fixed number of worker processes; each runs one expression at a time"""
+
+    def __init__(self, workers=SANDBOX_WORKERS, timeout=SANDBOX_TIMEOUT, memory_bytes=SANDBOX_MEMORY_BYTES):
+        self.timeout = timeout
+        self.memory_bytes = memory_bytes
+        # spawn rather than fork, forking a process that runs Streamlit threads is unsafe
+        self.context = multiprocessing.get_context("spawn")
+        self.idle = [_Worker(self.context, memory_bytes) for _ in range(workers)]
+        self.condition = threading.Condition()
+        self.restarts = 0
+
+    def _acquire(self):
+        with self.condition:
+            while not self.idle:
+                self.condition.wait()
+            return self.idle.pop()
+
+    def _release(self, worker):
+        with self.condition:
+            self.idle.append(worker)
+            self.condition.notify()
+
+    def preload(self, path):
+        """Have the idle workers load a dataset before it is asked about"""
+        with self.condition:
+            for worker in self.idle:
+                try:
+                    worker.conn.send(("load", path))
+                except OSError:
+                    pass
+
+    def run(self, path, output, others=None):
+        """The parser output for `output` on the CSV at `path`, as PandasInstructionParser gives it.
+
+        `others` are more CSVs the code may use, as {variable name: path}.
+        """
+        queued = time.perf_counter()
+        worker = self._acquire()
+        attrs = {"pid": worker.process.pid}
+        try:
+            if not worker.wait_ready(STARTUP_TIMEOUT):
+                raise EOFError("worker did not start")
+            start = time.perf_counter()
+            attrs["wait"] = start - queued
+            worker.conn.send(("run", path, output, others or {}))
+            if worker.conn.poll(self.timeout):
+                text, attrs["worker_seconds"] = worker.conn.recv()
+            else:
+                attrs["timeout"] = True
+                text = ERROR_PREFIX + f"the expression did not finish within {self.timeout:g} seconds"
+                worker = self._replace(worker)
+        except (EOFError, OSError):
+            start = time.perf_counter()
+            # The worker died (killed for memory by the OS, or crashed)
+            attrs["crashed"] = True
+            text = ERROR_PREFIX + "the expression stopped the process running it"
+            worker = self._replace(worker)
+        finally:
+            self._release(worker)
+        if len(text) > MAX_RESULT_CHARS:
+            attrs["truncated"] = len(text)
+            text = text[:MAX_RESULT_CHARS] + f"\n... ({len(text) - MAX_RESULT_CHARS} more characters)"
+        get_tracer().record("sandbox_run", time.perf_counter() - start, **attrs)
+        return text
+
+    def _replace(self, worker):
+        worker.kill()
+        self.restarts += 1
+        get_tracer().count("sandbox_restarts")
+        return _Worker(self.context, self.memory_bytes)
+
+    def stats(self):
+        with self.condition:
+            return {"idle": len(self.idle), "restarts": self.restarts}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox():
+    """The process-wide worker pool, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+        return _pool
+
+
+class SandboxedInstructionParser(ChainableOutputParser):
+    """Drop-in for PandasInstructionParser that evaluates in the worker pool"""
+
+    def __init__(self, path, others=None):
+        self.path = path
+        self.others = others or {}
+
+    def parse(self, output):
+        return get_sandbox().run(self.path, output, self.others)
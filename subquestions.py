@@ -0,0 +1,108 @@
+import os
+import re
+import time
+import asyncio
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.schema import MetadataMode
+from compress import CONTEXT_TOKEN_BUDGET, ContextCompressor
+from tracing import get_tracer
+
+# Sub-questions retrieved and answered at the same time
+SUBQUESTION_CONCURRENCY = int(os.environ.get("DORA_SUBQUESTION_CONCURRENCY", 4))
+MAX_SUBQUESTIONS = int(os.environ.get("DORA_MAX_SUBQUESTIONS", 5))
+
+# Cheap test before spending an LLM call on decomposition. Only clear signs count, a bare "and"
+# ("terms and conditions") is no reason to split: several question marks, an explicit comparison,
+# or a conjunction starting a second question ("what is X and how does Y ...")
+_compound_re = re.compile(
+    r"\?.*\?"
+    r"|\b(compare|compared|comparison|versus|vs\.?|differences? between)\b"
+    r"|\b(and|or|as well as|also)\s+(what|how|why|when|where|which|who|whose|is|are|was|were|does|do|did|can|could|should|will)\b",
+    re.IGNORECASE)
+_bullet_re = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+decompose_prompt = PromptTemplate(
+    "Split the question into at most {max_subquestions} self-contained sub-questions that can each be "
+    "answered from a separate search of the documents. Resolve references to the conversation so every "
+    "sub-question stands on its own. Write one sub-question per line and nothing else. If the question "
+    "asks for a single thing, write it unchanged on one line.\n\n"
+    "Conversation so far:\n{history}\n"
+    "Question: {query_str}\n"
+    "Sub-questions:\n"
+)
+
+answer_prompt = PromptTemplate(
+    "Answer the question using only the context below. Be complete but brief; say so if the context "
+    "does not contain the answer.\n\n"
+    "Context:\n{context_str}\n\n"
+    "Question: {query_str}\n"
+    "Answer: "
+)
+
+synthesis_prompt = PromptTemplate(
+    "{system_prompt}\n\n"
+    "Conversation so far:\n{history}\n"
+    "The question was split into sub-questions, each answered from the documents:\n\n{answers}\n\n"
+    "Using only these answers, write one complete answer to the original question.\n"
+    "Question: {query_str}\n"
+    "Answer: "
+)
+
+
+def looks_compound(query):
+    return bool(_compound_re.search(query))
+
+
+def decompose(query, llm, history=""):
+    """Sub-questions of a query (just the query when it asks one thing)"""
+    text = llm.complete(decompose_prompt.format(
+        max_subquestions=MAX_SUBQUESTIONS, history=history or "(none)\n", query_str=query)).text
+    lines = [_bullet_re.sub("", line).strip() for line in text.splitlines()]
+    subquestions = list(dict.fromkeys(line for line in lines if line))[:MAX_SUBQUESTIONS]
+    return subquestions or [query]
+
+
+def _retrieve(retriever, question, token_budget):
+    nodes = retriever.retrieve(question)
+    return ContextCompressor(token_budget=token_budget).postprocess_nodes(nodes, query_str=question)
+
+
+async def _answer(question, retriever, llm, semaphore, token_budget):
+    queued = time.perf_counter()
+    async with semaphore:
+        start = time.perf_counter()
+        # Retrievers and the compressor are synchronous, a worker thread keeps the loop free
+        nodes = await asyncio.to_thread(_retrieve, retriever, question, token_budget)
+        retrieved = time.perf_counter()
+        context = "\n\n".join(hit.node.get_content(metadata_mode=MetadataMode.LLM) for hit in nodes)
+        response = await llm.acomplete(answer_prompt.format(context_str=context, query_str=question))
+        end = time.perf_counter()
+    get_tracer().record("subquestion", end - start, retrieve=retrieved - start, llm=end - retrieved)
+    return {"question": question, "answer": response.text, "nodes": nodes, "wait": start - queued,
+            "retrieve": retrieved - start, "llm": end - retrieved, "total": end - start}
+
+
+def answer_subquestions(subquestions, retriever, llm, concurrency=SUBQUESTION_CONCURRENCY):
+    """Retrieve for and answer every sub-question concurrently, at most `concurrency` at a time.
+
+    `llm` must be safe to use from a new event loop (for OpenAI: reuse_client=False).
+    Returns one dict per sub-question, in order, with its answer, nodes and timings.
+    """
+    # The context budget is shared out so the synthesis prompt stays the size of a normal turn
+    token_budget = max(CONTEXT_TOKEN_BUDGET // len(subquestions), 200)
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(_answer(question, retriever, llm, semaphore, token_budget)
+                                      for question in subquestions))
+
+    return asyncio.run(run_all())
+
+
+def synthesize(query, results, llm, system_prompt, history=""):
+    """Stream the final answer built from the sub-answers, token by token"""
+    answers = "\n\n".join(f"Sub-question: {r['question']}\nAnswer: {r['answer']}" for r in results)
+    prompt = synthesis_prompt.format(system_prompt=system_prompt, history=history or "(none)\n",
+                                     answers=answers, query_str=query)
+    for response in llm.stream_complete(prompt):
+        yield response.delta or ""
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from llama_index.core import Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+TREE_FILE = "summary_tree.json"
+# Parallel LLM calls while building the tree
+SUMMARY_CONCURRENCY = int(os.environ.get("DORA_SUMMARY_CONCURRENCY", 4))
+# Longer files are summarised piece by piece, then the pieces are combined
+MAX_PIECE_CHARS = 12000
+# File summaries per section, projects with fewer files have no section level
+SECTION_SIZE = 8
+
+file_prompt = (
+    "Write a concise summary of the following text from the document '{name}'. "
+    "Keep the key facts, figures, names and conclusions.\n\n"
+    "{text}\n\n"
+    "Summary:"
+)
+reduce_prompt = (
+    "Combine the following summaries into one concise summary. "
+    "Keep the key facts, figures, names and conclusions, and avoid repetitions.\n\n"
+    "{summaries}\n\n"
+    "Summary:"
+)
+
+
+def tree_path(role, project_name):
+    return f"{role}/summary/{project_name}/{TREE_FILE}"
+
+
+def load_summary_tree(role, project_name):
+    path = tree_path(role, project_name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_summary_tree(role, project_name, tree):
+    path = tree_path(role, project_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(tree, f)
+    os.replace(path + ".tmp", path)
+
+
+def tree_is_current(tree, hashes):
+    """Whether the tree already covers exactly these file versions"""
+    return tree is not None and {name: entry["hash"] for name, entry in tree["files"].items()} == hashes
+
+
+def _key(parts):
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _complete(llm, prompt):
+    return llm.complete(prompt).text.strip()
+
+
+def _reduce(llm, pool, summaries):
+    """Combine summaries in rounds of at most SECTION_SIZE until one is left"""
+    while len(summaries) > 1:
+        groups = [summaries[i:i + SECTION_SIZE] for i in range(0, len(summaries), SECTION_SIZE)]
+        summaries = list(pool.map(lambda group: _complete(llm, reduce_prompt.format(summaries="\n\n".join(group))), groups))
+    return summaries[0] if summaries else ""
+
+
+def _summarize_file(llm, pool, name, text):
+    pieces = [text[i:i + MAX_PIECE_CHARS] for i in range(0, len(text), MAX_PIECE_CHARS)] or [""]
+    summaries = list(pool.map(lambda piece: _complete(llm, file_prompt.format(name=name, text=piece)), pieces))
+    return _reduce(llm, pool, summaries)
+
+
+def update_summary_tree(role, project_name, hashes, texts, load_text, llm=None):
+    """Bring the project's summary tree up to date and persist it.
+
+    `hashes` maps every current file to its content hash, `texts` holds the
+    text of files that were just parsed, and `load_text(name)` is used for
+    any other file whose summary is missing. Only files whose hash changed
+    are re-summarised, and only sections whose files changed are reduced again.
+    """
+    llm = llm or Settings.llm
+    tree = load_summary_tree(role, project_name) or {"files": {}, "sections": [], "project": None}
+    files = {name: entry for name, entry in tree["files"].items() if name in hashes}
+    stale = [name for name in hashes if files.get(name, {}).get("hash") != hashes[name]]
+
+    # File-level tasks fan their pieces out to a second pool, so they never
+    # block waiting on threads of their own pool
+    with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as outer, \
+            ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as pool:
+        def summarize(name):
+            text = texts[name] if name in texts else load_text(name)
+            return name, _summarize_file(llm, pool, name, text)
+
+        for name, summary in outer.map(summarize, stale):
+            files[name] = {"hash": hashes[name], "summary": summary}
+
+        names = sorted(files)
+        groups = [names[i:i + SECTION_SIZE] for i in range(0, len(names), SECTION_SIZE)] if len(names) > SECTION_SIZE else []
+        old_sections = {section["key"]: section for section in tree["sections"]}
+        sections = []
+        for group in groups:
+            key = _key([files[name]["summary"] for name in group])
+            sections.append(old_sections.get(key) or {"key": key, "files": group, "summary": None})
+        todo = [section for section in sections if section["summary"] is None]
+        prompts = [reduce_prompt.format(summaries="\n\n".join(files[name]["summary"] for name in section["files"]))
+                   for section in todo]
+        for section, summary in zip(todo, pool.map(lambda prompt: _complete(llm, prompt), prompts)):
+            section["summary"] = summary
+
+        top = [section["summary"] for section in sections] or [files[name]["summary"] for name in names]
+        key = _key(top)
+        project = tree["project"]
+        if project is None or project["key"] != key:
+            project = {"key": key, "summary": _reduce(llm, pool, top) if top else ""}
+
+    tree = {"files": files, "sections": sections, "project": project}
+    save_summary_tree(role, project_name, tree)
+    return tree
+
+
+def summary_context(tree, query, max_chars=MAX_PIECE_CHARS):
+    """Pick the tree level that answers a summary-style query.
+
+    Files named in the query get their own summaries; otherwise the project
+    summary is followed by as many section (or file) summaries as fit in `max_chars`.
+    """
+    lowered = query.lower()
+    named = []
+    for name in tree["files"]:
+        stem = os.path.splitext(name)[0].lower()
+        # Very short stems would match inside ordinary words
+        if name.lower() in lowered or (len(stem) >= 3 and stem in lowered):
+            named.append(name)
+    if named:
+        return [(f"Summary of {name}", tree["files"][name]["summary"]) for name in named]
+
+    parts = [("Summary of the whole project", tree["project"]["summary"])]
+    used = len(parts[0][1])
+    if tree["sections"]:
+        details = [(f"Summary of {', '.join(section['files'])}", section["summary"]) for section in tree["sections"]]
+    else:
+        details = [(f"Summary of {name}", entry["summary"]) for name, entry in sorted(tree["files"].items())]
+    for title, text in details:
+        if used + len(text) > max_chars:
+            break
+        parts.append((title, text))
+        used += len(text)
+    return parts
+
+
+class SummaryTreeRetriever(BaseRetriever):
+    """Retriever that serves precomputed summaries instead of every node of the project"""
+
+    def __init__(self, tree, **kwargs):
+        self._tree = tree
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return [
+            NodeWithScore(node=TextNode(text=f"{title}:\n{text}"), score=1.0)
+            for title, text in summary_context(self._tree, query_bundle.query_str)
+        ]
@@ -0,0 +1,91 @@
+import time
+import threading
+from typing import Any, Dict
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.embedding import EmbeddingStartEvent, EmbeddingEndEvent
+from llama_index.core.instrumentation.events.retrieval import RetrievalStartEvent, RetrievalEndEvent
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatStartEvent, LLMChatEndEvent, LLMCompletionStartEvent, LLMCompletionEndEvent,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.utils import get_tokenizer
+
+
+def _usage(response):
+    """(prompt, completion) token counts reported by the provider, or None"""
+    raw = getattr(response, "raw", None)
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+
+
+def _tokens(text):
+    return len(get_tokenizer()(text or ""))
+
+
+class TraceEventHandler(BaseEventHandler):
+    """Turns llama-index start/end events into embed, retrieve and llm spans"""
+
+    _tracer: Any = PrivateAttr()
+    # (span id, kind) -> start times; a list because threads can share a span id
+    _starts: Dict[Any, list] = PrivateAttr(default_factory=dict)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, tracer, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._tracer = tracer
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TraceEventHandler"
+
+    def _start(self, event, kind):
+        with self._lock:
+            self._starts.setdefault((event.span_id, kind), []).append(time.perf_counter())
+
+    def _end(self, event, kind):
+        with self._lock:
+            starts = self._starts.get((event.span_id, kind))
+            if not starts:
+                return None
+            start = starts.pop()
+            if not starts:
+                del self._starts[(event.span_id, kind)]
+        return time.perf_counter() - start
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> None:
+        if isinstance(event, EmbeddingStartEvent):
+            self._start(event, "embed")
+        elif isinstance(event, EmbeddingEndEvent):
+            duration = self._end(event, "embed")
+            if duration is not None:
+                self._tracer.record("embed", duration, texts=len(event.chunks))
+        elif isinstance(event, RetrievalStartEvent):
+            self._start(event, "retrieve")
+        elif isinstance(event, RetrievalEndEvent):
+            duration = self._end(event, "retrieve")
+            if duration is not None:
+                self._tracer.record("retrieve", duration, nodes=len(event.nodes))
+        elif isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            self._start(event, "llm")
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            duration = self._end(event, "llm")
+            if duration is None:
+                return
+            usage = _usage(event.response)
+            if usage is None or None in usage:
+                # Streamed responses don't report usage, count with the tokenizer instead
+                if isinstance(event, LLMChatEndEvent):
+                    prompt = "\n".join(str(msg.content or "") for msg in event.messages)
+                    completion = event.response.message.content if event.response else ""
+                else:
+                    prompt = event.prompt
+                    completion = event.response.text if event.response else ""
+                usage = (_tokens(prompt), _tokens(completion))
+            self._tracer.count("llm_prompt_tokens", usage[0])
+            self._tracer.count("llm_completion_tokens", usage[1])
+            self._tracer.record("llm", duration, prompt_tokens=usage[0], completion_tokens=usage[1])
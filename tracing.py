@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+TRACE_DIR = os.environ.get("DORA_TRACE_DIR", os.path.join(".cache", "traces"))
+SPANS_FILE = "spans.jsonl"
+METRICS_FILE = "metrics.prom"
+# spans.jsonl is rotated to spans.jsonl.1 past this size
+MAX_TRACE_FILE_BYTES = int(os.environ.get("DORA_TRACE_FILE_MB", 50)) * 1024 * 1024
+# Spans are written to the JSONL file in batches, by a background thread, at least this often
+FLUSH_SECONDS = float(os.environ.get("DORA_TRACE_FLUSH_SECONDS", 1.0))
+# or as soon as this many are waiting
+FLUSH_BATCH = 500
+# Durations kept per stage for the percentiles
+MAX_SAMPLES = int(os.environ.get("DORA_TRACE_SAMPLES", 5000))
+QUANTILES = (0.5, 0.95, 0.99)
+# Comma separated emails allowed to see the metrics page; nobody when unset
+ADMINS = {email.strip() for email in os.environ.get("DORA_ADMINS", "").split(",") if email.strip()}
+
+# (trace id, span id) of the span open in the current thread / task
+_current = contextvars.ContextVar("dora_span", default=None)
+
+
+class Tracer:
+    """Records timed spans, appends them to a JSONL file and keeps per-stage percentiles.
+
+    Spans opened inside another span share its trace id, so a whole ingest
+    or query turn can be pulled out of the JSONL by one id. Recording a span
+    only queues its line; a background thread appends the queue to the file,
+    so the traced code never waits on file I/O.
+    """
+
+    def __init__(self, trace_dir=TRACE_DIR, max_samples=MAX_SAMPLES):
+        self.trace_dir = trace_dir
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        # stage -> recent durations; stage -> [count, total seconds] since start
+        self.samples = {}
+        self.totals = {}
+        # counter name -> value, e.g. LLM prompt tokens
+        self.counters = {}
+        # JSONL lines not written yet; write_lock keeps batches in order
+        self.pending = []
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.writer = None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a block as a span; the yielded dict can be filled with more attributes"""
+        parent = _current.get()
+        trace_id = parent[0] if parent else uuid.uuid4().hex
+        span_id = uuid.uuid4().hex[:16]
+        token = _current.set((trace_id, span_id))
+        start_wall, start = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            if error:
+                attrs["error"] = error
+            self._emit(name, time.perf_counter() - start, start_wall, trace_id, span_id,
+                       parent[1] if parent else None, attrs)
+
+    def record(self, name, duration, **attrs):
+        """Record a span that was timed elsewhere (another process, an event pair)"""
+        parent = _current.get()
+        self._emit(name, duration, time.time() - duration, parent[0] if parent else uuid.uuid4().hex,
+                   uuid.uuid4().hex[:16], parent[1] if parent else None, attrs)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _emit(self, name, duration, start_wall, trace_id, span_id, parent_id, attrs):
+        line = json.dumps({
+            "name": name, "trace_id": trace_id, "span_id": span_id, "parent_id": parent_id,
+            "start": round(start_wall, 6), "duration": round(duration, 6), "attrs": attrs,
+        }, default=str)
+        with self.lock:
+            self.samples.setdefault(name, deque(maxlen=self.max_samples)).append(duration)
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+            self.pending.append(line + "\n")
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="dora-trace-writer", daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+            if len(self.pending) >= FLUSH_BATCH:
+                self.wake.set()
+
+    def _write_loop(self):
+        while True:
+            self.wake.wait(FLUSH_SECONDS)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Append the queued spans to the JSONL file"""
+        with self.write_lock:
+            with self.lock:
+                lines, self.pending = self.pending, []
+            if not lines:
+                return
+            try:
+                os.makedirs(self.trace_dir, exist_ok=True)
+                path = os.path.join(self.trace_dir, SPANS_FILE)
+                if os.path.exists(path) and os.path.getsize(path) > MAX_TRACE_FILE_BYTES:
+                    os.replace(path, path + ".1")
+                with open(path, "a") as f:
+                    f.write("".join(lines))
+            except OSError:
+                # Tracing must never break a request
+                pass
+
+    def stage_stats(self):
+        """stage -> {count, total, p50, p95, p99} (percentiles over the recent samples, in seconds)"""
+        with self.lock:
+            samples = {name: np.asarray(values) for name, values in self.samples.items()}
+            totals = {name: tuple(total) for name, total in self.totals.items()}
+        stats = {}
+        for name, values in sorted(samples.items()):
+            p50, p95, p99 = np.quantile(values, QUANTILES)
+            stats[name] = {"count": totals[name][0], "total": totals[name][1],
+                           "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+        return stats
+
+    def prometheus(self):
+        """Prometheus text exposition of the stage latencies and counters"""
+        lines = ["# HELP dora_stage_seconds Latency of traced stages.", "# TYPE dora_stage_seconds summary"]
+        for name, stats in self.stage_stats().items():
+            for q in QUANTILES:
+                lines.append(f'dora_stage_seconds{{stage="{name}",quantile="{q}"}} {stats[f"p{round(q * 100)}"]:.6f}')
+            lines.append(f'dora_stage_seconds_sum{{stage="{name}"}} {stats["total"]:.6f}')
+            lines.append(f'dora_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+        with self.lock:
+            counters = dict(self.counters)
+        lines += ["# HELP dora_events_total Counted events (tokens, cache hits).", "# TYPE dora_events_total counter"]
+        for name, value in sorted(counters.items()):
+            lines.append(f'dora_events_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self):
+        """Write the Prometheus text next to the spans (for a node exporter textfile collector)"""
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, METRICS_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+        return path
+
+    def recent_spans(self, limit=200):
+        """The last `limit` spans of the JSONL file, newest first"""
+        self.flush()
+        try:
+            with open(os.path.join(self.trace_dir, SPANS_FILE)) as f:
+                lines = deque(f, maxlen=limit)
+        except FileNotFoundError:
+            return []
+        return [json.loads(line) for line in reversed(lines)]
+
+
+_tracer = Tracer()
+_installed = False
+_install_lock = threading.Lock()
+
+
+def get_tracer():
+    """The process-wide tracer"""
+    return _tracer
+
+
+def install_tracing():
+    """Hook the tracer into llama-index's instrumentation (once per process) for embed, retrieve and llm spans"""
+    global _installed
+    with _install_lock:
+        if not _installed:
+            # Imported here: llama-index is heavy, and pages like the login page never need it
+            from llama_index.core.instrumentation import get_dispatcher
+            from trace_events import TraceEventHandler
+            get_dispatcher().add_event_handler(TraceEventHandler(_tracer))
+            _installed = True
+    return _tracer
+
+
+def is_admin(role):
+    """Whether a signed-in user may see the traces, which name every user's projects and files"""
+    return role in ADMINS
+
+
+def span(name, **attrs):
+    return _tracer.span(name, **attrs)
@@ -0,0 +1,83 @@
+"""Background preloading of heavy dependencies, and a report of what importing them costs.
+
+    python warmup.py    # cold import time of every heavy module, in a fresh process
+"""
+import os
+import sys
+import time
+import importlib
+import threading
+from tracing import get_tracer, span
+
+# Preload heavy modules in a background thread when the server handles its first page
+WARMUP = os.environ.get("DORA_WARMUP", "1") == "1"
+
+# Heaviest first: the pages that need them are the ones users open first
+HEAVY_MODULES = [
+    "llama_index.core",
+    "llama_index.llms.openai",
+    "llama_index.embeddings.openai",
+    "pandas",
+    "llama_index.experimental.query_engine.pandas",
+    "lida",
+    "matplotlib.pyplot",
+    "PIL.Image",
+    "pptx",
+]
+
+# module -> seconds its first import took in this process
+IMPORT_TIMES = {}
+_lock = threading.Lock()
+_started = False
+
+
+def timed_import(name):
+    """Import a module, recording how long it took if this is its first import"""
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    with _lock:
+        IMPORT_TIMES.setdefault(name, elapsed)
+    get_tracer().record("import", elapsed, module=name)
+    return module
+
+
+def preload(modules=HEAVY_MODULES):
+    with span("warmup"):
+        for name in modules:
+            try:
+                timed_import(name)
+            except Exception:
+                # A missing optional dependency only matters to the page that uses it
+                continue
+        # Shared resources that need no credentials
+        from embed_cache import get_store
+        get_store()
+
+
+def start_warmup():
+    """Start preloading once per process (no-op when DORA_WARMUP=0)"""
+    global _started
+    with _lock:
+        if _started or not WARMUP:
+            return
+        _started = True
+    threading.Thread(target=preload, name="warmup", daemon=True).start()
+
+
+def import_report():
+    """[(module, seconds)] of the first imports recorded in this process, slowest first"""
+    with _lock:
+        return sorted(IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True)
+
+
+if __name__ == "__main__":
+    # Modules share dependencies, so each is measured in its own interpreter
+    import subprocess
+    for name in HEAVY_MODULES:
+        code = f"import time; t = time.perf_counter(); import {name}; print(time.perf_counter() - t)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        cost = f"{float(result.stdout.strip().splitlines()[-1]) * 1000:8.0f} ms" if result.returncode == 0 else "  not installed"
+        print(f"{name:<50} {cost}")